@@ -13,20 +13,64 @@ class Settings:
 	vllm_api_key: str = os.getenv("VLLM_API_KEY", "dev")
 	qwen_model: str = os.getenv("QWEN_MODEL", "Qwen/Qwen3-4B-Instruct-2507")
 
+	# Outgoing HTTP connection pool (shared by product search and Gemini clients)
+	http_max_connections: int = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+	http_max_keepalive_connections: int = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+	http_keepalive_expiry: float = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+
 	# Product Search Service settings
 	product_search_base_url: str = os.getenv("PRODUCT_SEARCH_BASE_URL", "http://product_search:8001")
+	# Max simultaneous searches across all jobs in this process
+	product_search_concurrency: int = int(os.getenv("PRODUCT_SEARCH_CONCURRENCY", "8"))
+	# In-process LRU cache of search results (TTL 0 disables the cache)
+	product_search_cache_ttl_seconds: int = int(os.getenv("PRODUCT_SEARCH_CACHE_TTL_SECONDS", "3600"))
+	product_search_cache_max_entries: int = int(os.getenv("PRODUCT_SEARCH_CACHE_MAX_ENTRIES", "1024"))
 
 	# Gemini API settings
 	gemini_api_key: str | None = os.getenv("GEMINI_API_KEY")
 	gemini_model: str = os.getenv("GEMINI_MODEL", "gemini-1.5-pro")
+	# Decode budget of the planning turn: 2-3 search_products calls, plus thinking on models that use it
+	gemini_plan_max_output_tokens: int = int(os.getenv("GEMINI_PLAN_MAX_OUTPUT_TOKENS", "256"))
+
+	# Background job storage: Redis shares jobs across workers; empty keeps them in process memory
+	redis_url: str = os.getenv("REDIS_URL", "")
+	job_ttl_seconds: int = int(os.getenv("JOB_TTL_SECONDS", "3600"))
+
+	# Semantic cache for Gemini planning results (TTL 0 disables the cache)
+	plan_cache_ttl_seconds: int = int(os.getenv("PLAN_CACHE_TTL_SECONDS", "86400"))
+	plan_cache_similarity: float = float(os.getenv("PLAN_CACHE_SIMILARITY", "0.95"))
+	plan_cache_max_entries: int = int(os.getenv("PLAN_CACHE_MAX_ENTRIES", "512"))
+	# SQLite file shared by workers on the same node; empty keeps the cache in memory only
+	plan_cache_path: str = os.getenv("PLAN_CACHE_PATH", "")
+
+	# Uploads above this pixel count are rejected before decoding
+	max_image_pixels: int = int(os.getenv("MAX_IMAGE_PIXELS", "40000000"))
+
+	# MedGemma backend: "transformers" loads the model in-process, "vllm" calls an OpenAI-compatible server
+	medgemma_backend: str = os.getenv("MEDGEMMA_BACKEND", "transformers")
+	medgemma_model: str = os.getenv("MEDGEMMA_MODEL", "google/medgemma-4b-it")
+	# Start the server with --enable-prefix-caching: the constant system prompt is then prefilled once
+	medgemma_vllm_base_url: str = os.getenv("MEDGEMMA_VLLM_BASE_URL", "http://vllm:8002/v1")
 
 	# MedGemma generation length (lower = faster). Default tuned for speed/quality.
 	medgemma_max_new_tokens: int = int(os.getenv("MEDGEMMA_MAX_NEW_TOKENS", "1024"))
+	# Basic mode asks for a short summary, so it gets a smaller budget
+	medgemma_basic_max_new_tokens: int = int(os.getenv("MEDGEMMA_BASIC_MAX_NEW_TOKENS", "384"))
+	# Micro-batching: concurrent analyses collected within the wait window share one generate pass
+	medgemma_max_batch_size: int = int(os.getenv("MEDGEMMA_MAX_BATCH_SIZE", "4"))
+	medgemma_batch_wait_ms: int = int(os.getenv("MEDGEMMA_BATCH_WAIT_MS", "25"))
+	# bitsandbytes weight quantization for MedGemma: "none", "int8" or "int4" (NF4)
+	medgemma_quantization: str = os.getenv("MEDGEMMA_QUANTIZATION", "none")
+	# torch.compile the MedGemma forward pass (slow first request, faster decode afterwards)
+	medgemma_compile: bool = os.getenv("MEDGEMMA_COMPILE", "false").lower() in {"1", "true", "yes"}
+	# Load MedGemma at startup; when disabled the first analysis request triggers the load
+	preload_medgemma: bool = os.getenv("PRELOAD_MEDGEMMA", "true").lower() in {"1", "true", "yes"}
 
 	google_cse_api_key: str | None = os.getenv("GOOGLE_CSE_API_KEY")
 	google_cse_cx: str | None = os.getenv("GOOGLE_CSE_CX")
 
-	torch_dtype: str = os.getenv("TORCH_DTYPE", "bf16")
+	# "auto" picks bf16/fp16/fp32 by hardware; bf16, fp16 or fp32 force a dtype
+	torch_dtype: str = os.getenv("TORCH_DTYPE", "auto")
 	device_map: str = os.getenv("DEVICE_MAP", "auto")
 
 
@@ -5,13 +5,15 @@ from pydantic import BaseModel, ValidationError
 from typing import Any
 import io
 from PIL import Image
-import httpx
 import asyncio
-import json
+import orjson
 
-from app.services.medgemma import MedGemmaService
+from app.config import settings
+from app.services.medgemma import MedGemmaService, close_vllm_client
 from app.schemas import AnalyzeResponse
 from app.utils.logging import get_logger
+from app.utils.http import get_http_client, close_http_client
+from app.utils.json_stream import StreamingJSONObject
 from app.services.job_manager import job_manager, JobStatus
 
 from app.services.supabase_service import (
@@ -23,6 +25,9 @@ from app.services.supabase_service import (
 )
 from app.services.product_search_client import ProductSearchClient
 
+# Отклоняем гигантские изображения до декодирования (Pillow бросает DecompressionBombError при 2x лимита)
+Image.MAX_IMAGE_PIXELS = settings.max_image_pixels
+
 app = FastAPI(title="Skin Analyze API", version="0.1.1")
 logger = get_logger("app")
 
@@ -45,17 +50,22 @@ app.add_middleware(
 @app.on_event("startup")
 async def on_startup():
     logger.info("API starting up")
-    try:
-        # Warm up MedGemma model to reduce first-request latency
-        MedGemmaService()
-        logger.info("MedGemma warmed up")
-    except Exception as e:
-        logger.warning(f"MedGemma warmup failed: {e}")
+    if settings.preload_medgemma:
+        try:
+            # Load MedGemma weights before accepting traffic so the first request doesn't pay for it
+            await asyncio.to_thread(MedGemmaService)
+            logger.info("MedGemma warmed up")
+        except Exception as e:
+            logger.warning("MedGemma warmup failed: %s", e)
+    MedGemmaService.start_batch_worker()
 
 
 @app.on_event("shutdown")
 async def on_shutdown():
     logger.info("API shutting down")
+    await MedGemmaService.stop_batch_worker()
+    await close_vllm_client()
+    await close_http_client()
 
 
 @app.get("/health")
@@ -63,32 +73,45 @@ async def health():
     return {"status": "ok"}
 
 
+def _decode_image(image_bytes: bytes) -> Image.Image:
+    image = Image.open(io.BytesIO(image_bytes))
+    # Для JPEG декодируем сразу в уменьшенном масштабе (не меньше нативного размера MedGemma)
+    image.draft("RGB", MedGemmaService.image_size)
+    return image.convert("RGB")
+
+
 async def _bytes_to_image(image_bytes: bytes) -> Image.Image:
     try:
-        return Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        # Декодирование — CPU-работа, не держим на ней event loop
+        return await asyncio.to_thread(_decode_image, image_bytes)
+    except Image.DecompressionBombError:
+        raise HTTPException(status_code=413, detail="Image is too large")
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid image data")
 
 
 async def _fetch_image_from_url(url: str) -> bytes:
     try:
-        async with httpx.AsyncClient(timeout=20.0) as client:
-            resp = await client.get(url)
-            resp.raise_for_status()
-            return resp.content
+        resp = await get_http_client().get(url, timeout=20.0)
+        resp.raise_for_status()
+        return resp.content
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to fetch image_url: {e}")
 
 
 async def _run_analysis_job(job_id: str, image: Image.Image, user_text: str | None, mode: str = "basic") -> None:
     timings: dict[str, float] = {}
+    # Незавершённые записи в Supabase: при ошибке дожидаемся их до записи "failed"
+    pending_writes: list[asyncio.Task] = []
     
     try:
-        # Обновляем статус в обеих системах - job_manager и Supabase
-        await supabase_service.update_job(job_id, SkinAnalysisJobUpdate(
+        # Запись прогресса в Supabase идёт параллельно со следующим шагом;
+        # перед следующей записью дожидаемся предыдущей, чтобы шаги не перепутались
+        progress_write = asyncio.create_task(supabase_service.update_job(job_id, SkinAnalysisJobUpdate(
             status="in_progress",
             progress={"step": "starting_analysis"}
-        ))
+        )))
+        pending_writes.append(progress_write)
         
         # Step 1: MedGemma - ИСПРАВЛЕНО: передаем user_text
         mode_norm = (mode or "basic").strip().lower()
@@ -101,11 +124,13 @@ async def _run_analysis_job(job_id: str, image: Image.Image, user_text: str | No
         timings["medgemma_seconds"] = round(medgemma_time, 2)
         
         # Обновляем прогресс
-        job_manager.update_progress(job_id, {"medgemma_summary": visual_summary, "timings": timings})
-        await supabase_service.update_job(job_id, SkinAnalysisJobUpdate(
+        await job_manager.update_progress(job_id, {"medgemma_summary": visual_summary, "timings": timings})
+        await progress_write
+        progress_write = asyncio.create_task(supabase_service.update_job(job_id, SkinAnalysisJobUpdate(
             progress={"step": "medgemma_completed", "medgemma_summary": visual_summary},
             timings=timings
-        ))
+        )))
+        pending_writes.append(progress_write)
 
         # Step 2: Gemini planning with tool
         from app.services.gemini_client import GeminiClient  # local import to avoid startup latency
@@ -123,23 +148,33 @@ async def _run_analysis_job(job_id: str, image: Image.Image, user_text: str | No
         gemini_plan_time = asyncio.get_running_loop().time() - start_time
         timings["gemini_plan_seconds"] = round(gemini_plan_time, 2)
         
-        job_manager.update_progress(job_id, {"planning": planning, "timings": timings})
-        await supabase_service.update_job(job_id, SkinAnalysisJobUpdate(
+        await job_manager.update_progress(job_id, {"planning": planning, "timings": timings})
+        await progress_write
+        progress_write = asyncio.create_task(supabase_service.update_job(job_id, SkinAnalysisJobUpdate(
             progress={"step": "planning_completed", "planning": planning},
             timings=timings
-        ))
+        )))
+        pending_writes.append(progress_write)
 
         # Step 3: Finalization
         start_time = asyncio.get_running_loop().time()
-        final_text = gemini.finalize_with_products(
-            json.dumps(planning, ensure_ascii=False),
-            json.dumps(products, ensure_ascii=False),
-        )
+        # Стримим ответ Gemini: завершённые поля JSON сразу видны в /status.
+        # Прогресс публикуем только когда дописано новое поле, а не на каждый токен
+        final_chunks: list[str] = []
+        final_stream = StreamingJSONObject()
+        async for chunk in gemini.stream_finalize_with_products(
+            orjson.dumps(planning).decode(),
+            orjson.dumps(products).decode(),
+        ):
+            final_chunks.append(chunk)
+            if final_stream.feed(chunk):
+                await job_manager.update_progress(job_id, {"final_fields": final_stream.fields})
+        final_text = "".join(final_chunks)
         gemini_finalize_time = asyncio.get_running_loop().time() - start_time
         timings["gemini_finalize_seconds"] = round(gemini_finalize_time, 2)
 
         try:
-            final = json.loads(final_text)
+            final = orjson.loads(final_text)
         except Exception:
             final = {
                 "diagnosis": planning.get("diagnosis", visual_summary[:200]),
@@ -153,8 +188,10 @@ async def _run_analysis_job(job_id: str, image: Image.Image, user_text: str | No
         final["medgemma_summary"] = visual_summary
         final["timings"] = timings
 
+        await progress_write
+
         # Сохраняем результат анализа в Supabase
-        await supabase_service.save_analysis_result(SkinAnalysisResult(
+        writes = [supabase_service.save_analysis_result(SkinAnalysisResult(
             job_id=job_id,
             diagnosis=final.get("diagnosis"),
             skin_type=final.get("skin_type"),
@@ -162,7 +199,7 @@ async def _run_analysis_job(job_id: str, image: Image.Image, user_text: str | No
             medgemma_summary=visual_summary,
             planning_data=planning,
             final_result=final
-        ))
+        ))]
 
         # Сохраняем продукты в Supabase
         if final.get("products"):
@@ -182,18 +219,24 @@ async def _run_analysis_job(job_id: str, image: Image.Image, user_text: str | No
                 ))
             
             if recommended_products:
-                await supabase_service.save_recommended_products(recommended_products)
+                writes.append(supabase_service.save_recommended_products(recommended_products))
 
         # Обновляем статус на завершенный
-        job_manager.complete(job_id, final)
-        await supabase_service.update_job(job_id, SkinAnalysisJobUpdate(
+        writes.append(supabase_service.update_job(job_id, SkinAnalysisJobUpdate(
             status="completed",
             timings=timings
-        ))
+        )))
+        # Независимые записи в Supabase идут параллельно
+        write_tasks = [asyncio.create_task(w) for w in writes]
+        pending_writes.extend(write_tasks)
+        await asyncio.gather(*write_tasks)
+        await job_manager.complete(job_id, final)
 
     except Exception as e:
         error_msg = str(e)
-        job_manager.fail(job_id, error_msg)
+        # Иначе запоздавшая запись прогресса или "completed" перетрёт статус "failed"
+        await asyncio.gather(*pending_writes, return_exceptions=True)
+        await job_manager.fail(job_id, error_msg)
         await supabase_service.update_job(job_id, SkinAnalysisJobUpdate(
             status="failed",
             error_message=error_msg
@@ -229,7 +272,7 @@ async def skin_analysis_start(body: SkinAnalysisRequest):
         pil_image = await _bytes_to_image(image_bytes)
 
         # Создаем background job в job_manager
-        job = job_manager.create()
+        job = await job_manager.create()
         
         # Создаем запись в Supabase
         await supabase_service.create_job(SkinAnalysisJobCreate(
@@ -266,7 +309,7 @@ async def get_analysis_status(job_id: str):
     Returns:
         Информация о статусе задачи включая прогресс и время выполнения
     """
-    job = job_manager.get(job_id)
+    job = await job_manager.get(job_id)
     if not job:
         raise HTTPException(status_code=404, detail="job_id not found")
     
@@ -291,7 +334,7 @@ async def get_analysis_result(job_id: str):
     Returns:
         Полный результат анализа кожи или информацию о статусе, если анализ еще не завершен
     """
-    job = job_manager.get(job_id)
+    job = await job_manager.get(job_id)
     if not job:
         raise HTTPException(status_code=404, detail="job_id not found")
     
@@ -311,7 +354,7 @@ async def get_analysis_result(job_id: str):
     try:
         validated = AnalyzeResponse(**(job.result or {}))
     except ValidationError as ve:
-        logger.error(f"Stored job result schema error: {ve}")
+        logger.error("Stored job result schema error: %s", ve)
         raise HTTPException(status_code=500, detail="Stored result schema error")
     
     return JSONResponse(content=validated.model_dump())
@@ -1,6 +1,7 @@
 from __future__ import annotations
 from typing import Dict, Any
-import json
+import logging
+import orjson
 from PIL import Image
 import time
 
@@ -19,8 +20,8 @@ async def analyze_skin_pipeline(image: Image.Image, user_text: str | None) -> Di
     visual_summary = await MedGemmaService.analyze_image(image, mode="extended")
     medgemma_time = time.perf_counter() - start_time
     timings["medgemma_seconds"] = round(medgemma_time, 2)
-    logger.info(f"[STEP 1] MedGemma visual_summary: {visual_summary}")
-    logger.info(f"[TIMING] MedGemma took {timings['medgemma_seconds']} seconds")
+    logger.info("[STEP 1] MedGemma visual_summary: %s", visual_summary)
+    logger.info("[TIMING] MedGemma took %s seconds", timings["medgemma_seconds"])
 
     # Step 2: Planning with Gemini using tool calling
     gemini = GeminiClient()
@@ -34,19 +35,22 @@ async def analyze_skin_pipeline(image: Image.Image, user_text: str | None) -> Di
         products = products or []
     gemini_plan_time = time.perf_counter() - start_time
     timings["gemini_plan_seconds"] = round(gemini_plan_time, 2)
-    logger.info(f"[STEP 2] Gemini planning result: {json.dumps(planning, ensure_ascii=False)}")
-    logger.info(f"[TIMING] Gemini planning took {timings['gemini_plan_seconds']} seconds")
+    # Полные JSON-дампы строим только если уровень INFO включён
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("[STEP 2] Gemini planning result: %s", orjson.dumps(planning).decode())
+    logger.info("[TIMING] Gemini planning took %s seconds", timings["gemini_plan_seconds"])
 
     # Step 3: Finalize answer with Gemini
     # ✅ Передаём JSON-строки, получаем готовый dict
     start_time = time.perf_counter()
-    final_gemini = gemini.finalize_with_products(
-        json.dumps(planning, ensure_ascii=False),
-        json.dumps(products, ensure_ascii=False)
+    final_gemini = await gemini.finalize_with_products(
+        orjson.dumps(planning).decode(),
+        orjson.dumps(products).decode()
     )
     gemini_finalize_time = time.perf_counter() - start_time
     timings["gemini_finalize_seconds"] = round(gemini_finalize_time, 2)
-    logger.info(f"[STEP 3] Gemini finalize raw output: {json.dumps(final_gemini, ensure_ascii=False)}")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("[STEP 3] Gemini finalize raw output: %s", orjson.dumps(final_gemini).decode())
 
     # ✅ НЕ ДЕЛАЕМ json.loads() — final_gemini уже dict!
     # Проверяем, не вернул ли Gemini fallback
@@ -75,7 +79,11 @@ async def analyze_skin_pipeline(image: Image.Image, user_text: str | None) -> Di
     final_response.update({k: v for k, v in final_gemini.items() if k != "products"})
     final_response["timings"] = timings
 
-    logger.info(f"[STEP 3] Final response: {json.dumps(final_response, ensure_ascii=False)}")
-    logger.info(f"[OVERALL TIMING] Total pipeline time: {timings['medgemma_seconds'] + timings['gemini_plan_seconds'] + timings['gemini_finalize_seconds']:.2f} seconds")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("[STEP 3] Final response: %s", orjson.dumps(final_response).decode())
+    logger.info(
+        "[OVERALL TIMING] Total pipeline time: %.2f seconds",
+        timings["medgemma_seconds"] + timings["gemini_plan_seconds"] + timings["gemini_finalize_seconds"],
+    )
 
     return final_response
\ No newline at end of file
@@ -0,0 +1,180 @@
+from __future__ import annotations
+from typing import Any, Dict, Optional, Tuple
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import hashlib
+import math
+import os
+import re
+import sqlite3
+import time
+
+import orjson
+
+from app.utils.logging import get_logger
+
+logger = get_logger("gemini_cache")
+
+_TOKEN_RE = re.compile(r"\w+")
+
+# Записи в SQLite (с ожиданием блокировки до timeout) не должны занимать event loop:
+# put() ставит их в один фоновый поток, который заодно сериализует запись
+_DB_WRITER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="semantic-cache")
+
+
+def embed_text(text: str) -> Dict[str, float]:
+    """
+    Лёгкий bag-of-words эмбеддинг текста (L2-нормированный).
+
+    Для сводок MedGemma этого достаточно, чтобы находить почти одинаковые
+    тексты, и не требует загрузки отдельной модели эмбеддингов.
+    """
+    counts = Counter(_TOKEN_RE.findall(text.lower()))
+    norm = math.sqrt(sum(v * v for v in counts.values())) or 1.0
+    return {token: v / norm for token, v in counts.items()}
+
+
+def cosine_similarity(a: Dict[str, float], b: Dict[str, float]) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(token, 0.0) for token, v in a.items())
+
+
+class SemanticCache:
+    """
+    In-process кэш с поиском ближайшего соседа по косинусной близости.
+
+    Сначала проверяется точное совпадение по хэшу текста, затем (если semantic=True)
+    ищется ближайший сосед. Значения хранятся и отдаются копиями.
+    Если задан path, записи дублируются в SQLite и подгружаются при старте,
+    так что кэш переживает рестарты и общий для воркеров на одном узле.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        threshold: float,
+        ttl_seconds: int,
+        max_entries: int,
+        path: Optional[str] = None,
+        semantic: bool = True,
+    ) -> None:
+        self.namespace = namespace
+        self.semantic = semantic
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # key -> (expires_at, embedding, value)
+        self._entries: OrderedDict[str, Tuple[float, Dict[str, float], Any]] = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        if path and self.enabled:
+            self._open_db(path)
+
+    def _open_db(self, path: str) -> None:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            db = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS semantic_cache ("
+                "key TEXT PRIMARY KEY, namespace TEXT NOT NULL, expires_at REAL NOT NULL, "
+                "embedding BLOB NOT NULL, value BLOB NOT NULL)"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS semantic_cache_namespace_expires "
+                "ON semantic_cache (namespace, expires_at)"
+            )
+            now = time.time()
+            db.execute("DELETE FROM semantic_cache WHERE expires_at <= ?", (now,))
+            rows = db.execute(
+                "SELECT key, expires_at, embedding, value FROM semantic_cache "
+                "WHERE namespace = ? ORDER BY expires_at DESC LIMIT ?",
+                (self.namespace, self.max_entries),
+            ).fetchall()
+        except (sqlite3.Error, OSError) as e:
+            logger.warning("Semantic cache disk store unavailable at %s: %s", path, e)
+            return
+
+        # Самые свежие записи должны оказаться в конце LRU
+        for key, expires_at, embedding, value in reversed(rows):
+            self._entries[key] = (expires_at, orjson.loads(embedding), orjson.loads(value))
+        self._db = db
+        logger.info("Semantic cache namespace=%s loaded %d entries from %s", self.namespace, len(rows), path)
+
+    def _persist(self, key: str, expires_at: float, embedding: Dict[str, float], value: Any) -> None:
+        if self._db is None:
+            return
+        _DB_WRITER.submit(self._write, key, expires_at, embedding, value)
+
+    def _write(self, key: str, expires_at: float, embedding: Dict[str, float], value: Any) -> None:
+        try:
+            self._db.execute(
+                "INSERT OR REPLACE INTO semantic_cache (key, namespace, expires_at, embedding, value) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, self.namespace, expires_at, orjson.dumps(embedding), orjson.dumps(value)),
+            )
+            # Файл держим в тех же границах, что и LRU в памяти: истёкшие и лишние старые записи удаляем
+            self._db.execute(
+                "DELETE FROM semantic_cache WHERE namespace = ? AND (expires_at <= ? OR key NOT IN ("
+                "SELECT key FROM semantic_cache WHERE namespace = ? ORDER BY expires_at DESC LIMIT ?))",
+                (self.namespace, time.time(), self.namespace, self.max_entries),
+            )
+        except (sqlite3.Error, TypeError) as e:
+            logger.warning("Semantic cache disk write failed: %s", e)
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl_seconds > 0 and self.max_entries > 0
+
+    def _key(self, text: str) -> str:
+        digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        return f"{self.namespace}:{digest}"
+
+    def _evict_expired(self, now: float) -> None:
+        expired = [k for k, (expires_at, _, _) in self._entries.items() if expires_at <= now]
+        for k in expired:
+            del self._entries[k]
+
+    def get(self, text: str) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        now = time.time()
+        self._evict_expired(now)
+
+        key = self._key(text)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            logger.info("Cache hit namespace=%s exact", self.namespace)
+            return copy.deepcopy(self._entries[key][2])
+        if not self.semantic:
+            return None
+
+        embedding = embed_text(text)
+        best_key, best_score = None, 0.0
+        for key, (_, cached_embedding, _) in self._entries.items():
+            score = cosine_similarity(embedding, cached_embedding)
+            if score > best_score:
+                best_key, best_score = key, score
+
+        if best_key is None or best_score < self.threshold:
+            return None
+
+        self._entries.move_to_end(best_key)
+        logger.info("Cache hit namespace=%s score=%.3f", self.namespace, best_score)
+        return copy.deepcopy(self._entries[best_key][2])
+
+    def put(self, text: str, value: Any) -> None:
+        if not self.enabled:
+            return
+        key = self._key(text)
+        expires_at = time.time() + self.ttl_seconds
+        # Без semantic поиск идёт только по хэшу, эмбеддинг не нужен
+        embedding = embed_text(text) if self.semantic else {}
+        value = copy.deepcopy(value)
+        self._entries[key] = (expires_at, embedding, value)
+        self._entries.move_to_end(key)
+        # Пишем ту же копию, что лежит в памяти: вызывающий код может менять свой объект
+        self._persist(key, expires_at, embedding, value)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -1,15 +1,23 @@
 from __future__ import annotations
-from typing import List, Dict, Any
-import json
-import time
+from typing import List, Dict, Any, AsyncIterator
 import asyncio
-
+import hashlib
+import functools
+import random
+import re
+from collections import Counter
+
+import httpx
+import orjson
 from google import genai
+from google.genai import errors as genai_errors
 from google.genai import types
 
 from app.config import settings
 from app.utils.logging import get_logger
-from app.services.product_search_client import ProductSearchClient
+from app.utils.http import HTTP_LIMITS
+from app.services.product_search_client import product_search_client
+from app.services.gemini_cache import SemanticCache
 
 logger = get_logger("gemini")
 
@@ -32,11 +40,20 @@ SYSTEM_PROMPT_FINAL = (
     "- routine_steps: recommended skincare routine steps\n"
     "- products: list of up to 5 items {name,url,price?,snippet?,image_url?} with specific purpose for each\n"
     "- additional_recommendations: lifestyle and care tips\n"
-    "- medgemma_summary: include the full MedGemma analysis text for reference\n"
     "STRICT OUTPUT REQUIREMENTS: Respond with a single valid JSON object ONLY, no markdown, no explanations, no code fences. "
     "DO NOT wrap the JSON in ```json or any other format. DO NOT add any prefix or suffix. JUST THE JSON."
 )
 
+# Локальный шаблон ответа, когда поиск не вернул ни одного продукта
+_DEFAULT_ROUTINE = [
+    "Cleanse gently twice a day",
+    "Apply a moisturizer suited to your skin type",
+    "Use broad-spectrum SPF 30+ every morning",
+]
+_DEFAULT_TIPS = (
+    "Avoid harsh scrubs, stay hydrated and consult a dermatologist if the condition worsens."
+)
+
 # Function declaration JSON schema used by SDK
 SEARCH_PRODUCTS_FUNCTION = types.FunctionDeclaration(
     name="search_products",
@@ -50,6 +67,265 @@ SEARCH_PRODUCTS_FUNCTION = types.FunctionDeclaration(
     },
 )
 
+SEARCH_PRODUCTS_TOOL = types.Tool(function_declarations=[SEARCH_PRODUCTS_FUNCTION])
+
+# Response schema for finalize (dict-based JSON schema; SDK accepts it)
+_FINALIZE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "diagnosis": {"type": "string"},
+        "skin_type": {"type": "string"},
+        "explanation": {"type": "string"},
+        "routine_steps": {"type": "array", "items": {"type": "string"}},
+        "products": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "url": {"type": "string"},
+                    "price": {"type": "string"},
+                    "snippet": {"type": "string"},
+                    "image_url": {"type": "string"},
+                },
+                "required": ["name", "url"],
+            },
+        },
+        "additional_recommendations": {"type": "string"},
+    },
+    # medgemma_summary не генерируем: вызывающий код подставляет исходный текст MedGemma сам
+    "required": ["diagnosis", "skin_type", "explanation", "products"],
+}
+
+# Request configs are immutable between calls, build them once at import.
+# Planning turns only need function calls: force tool calling and cap the decode length.
+# System prompts go first and stay byte-identical between calls, so Gemini's implicit
+# prefix caching can reuse them across requests
+_PLAN_CONFIG = types.GenerateContentConfig(
+    system_instruction=SYSTEM_PROMPT_PLAN,
+    tools=[SEARCH_PRODUCTS_TOOL],
+    tool_config=types.ToolConfig(
+        function_calling_config=types.FunctionCallingConfig(mode="ANY"),
+    ),
+    temperature=0.1,
+    candidate_count=1,
+    max_output_tokens=settings.gemini_plan_max_output_tokens,
+)
+_FINALIZE_CONFIG = types.GenerateContentConfig(
+    system_instruction=SYSTEM_PROMPT_FINAL,
+    temperature=0.1,
+    max_output_tokens=2048,
+    response_mime_type="application/json",
+    response_schema=_FINALIZE_SCHEMA,
+)
+
+# В finalize отдаём только поля, которые попадают в ответ: сниппеты бывают по несколько КБ
+# и целиком уходят в prefill. Модель выбирает до 5 продуктов, оставляем ей небольшой запас
+_FINALIZE_MAX_PRODUCTS = 8
+_FINALIZE_SNIPPET_CHARS = 160
+
+
+def _slim_product(p: Dict[str, Any]) -> Dict[str, Any]:
+    slim = {
+        "name": p.get("name"),
+        "url": p.get("url"),
+        "price": p.get("price"),
+        "snippet": (p.get("snippet") or "")[:_FINALIZE_SNIPPET_CHARS],
+        "image_url": p.get("image_url"),
+    }
+    return {k: v for k, v in slim.items() if v}
+
+
+# Версия кэша планирования меняется вместе с промптом, что инвалидирует старые записи
+_PLAN_CACHE_VERSION = hashlib.sha1(SYSTEM_PROMPT_PLAN.encode("utf-8")).hexdigest()[:8]
+
+# Кэш результатов поиска продуктов по похожим сводкам MedGemma
+plan_cache = SemanticCache(
+    namespace=f"skin:plan:{_PLAN_CACHE_VERSION}",
+    threshold=settings.plan_cache_similarity,
+    ttl_seconds=settings.plan_cache_ttl_seconds,
+    max_entries=settings.plan_cache_max_entries,
+    path=settings.plan_cache_path or None,
+)
+
+# Точный кэш финального ответа по (plan, products); версия привязана к финальному промпту
+_FINAL_CACHE_VERSION = hashlib.sha1(SYSTEM_PROMPT_FINAL.encode("utf-8")).hexdigest()[:8]
+final_cache = SemanticCache(
+    namespace=f"skin:final:{_FINAL_CACHE_VERSION}",
+    threshold=1.0,
+    ttl_seconds=settings.plan_cache_ttl_seconds,
+    max_entries=settings.plan_cache_max_entries,
+    path=settings.plan_cache_path or None,
+    semantic=False,
+)
+
+
+# Эвристики по тексту MedGemma: (результат, ключевые слова). Порядок правил сохраняется в выдаче
+_QUERY_RULES = (
+    ("pore cleansing treatment", ("blackhead", "comedone", "pore")),
+    ("hydrating moisturizer", ("dehydrat", "dry")),
+    ("acne treatment serum", ("acne", "pimple", "pustule")),
+    ("anti-aging cream", ("aging", "fine line", "wrinkle")),
+    ("brightening serum", ("hyperpigmentation", "dark spot", "sun damage")),
+    ("soothing skincare", ("inflam", "redness", "irritat")),
+    ("oil control products", ("oily", "sebum")),
+    ("gentle skincare", ("sensitive",)),
+)
+# Клинический приоритет запросов: выраженные состояния ищем в первую очередь
+_QUERY_WEIGHTS = {
+    "acne treatment serum": 3,
+    "brightening serum": 3,
+    "pore cleansing treatment": 2,
+    "hydrating moisturizer": 2,
+    "anti-aging cream": 2,
+    "soothing skincare": 2,
+    "oil control products": 2,
+    "gentle skincare": 1,
+}
+_CONCERN_RULES = (
+    ("blackheads and comedones", ("blackhead", "comedone")),
+    ("dehydration", ("dehydrat",)),
+    ("acne", ("acne",)),
+    ("hyperpigmentation", ("hyperpigmentation",)),
+    ("signs of aging", ("aging", "fine line")),
+    ("inflammation and redness", ("inflam", "redness")),
+)
+_DEFICIENCY_RULES = (
+    ("moisture", ("dehydrat", "dry")),
+    ("radiance", ("dull",)),
+)
+_EXCESS_RULES = (
+    ("sebum production", ("oily", "sebum")),
+    ("clogged pores", ("comedone",)),
+)
+_EXTRA_KEYWORDS = ("normal", "barrier", "compromised")
+
+_KEYWORDS = {
+    keyword
+    for rules in (_QUERY_RULES, _CONCERN_RULES, _DEFICIENCY_RULES, _EXCESS_RULES)
+    for _, keywords in rules
+    for keyword in keywords
+} | set(_EXTRA_KEYWORDS)
+# Одна альтернация вместо десятков проверок `in`: текст сканируется за один проход
+_KEYWORD_RE = re.compile("|".join(sorted(map(re.escape, _KEYWORDS), key=len, reverse=True)))
+
+
+def _scan_keywords(low: str) -> frozenset[str]:
+    """Все ключевые слова эвристик, встречающиеся в (уже приведённом к нижнему регистру) тексте"""
+    return frozenset(_KEYWORD_RE.findall(low))
+
+
+def _count_keywords(low: str) -> Counter:
+    """Сколько раз встречается каждое ключевое слово (за тот же один проход регулярки)"""
+    return Counter(_KEYWORD_RE.findall(low))
+
+
+def _apply_rules(rules: tuple, hits: frozenset[str]) -> List[str]:
+    return [label for label, keywords in rules if not hits.isdisjoint(keywords)]
+
+
+# Обе эвристики — чистые функции текста сводки, поэтому кэшируются (повторные сводки частые).
+# Принимают уже приведённую к нижнему регистру сводку: вызывающий код делает .lower() один раз.
+# Возвращаются кортежи, чтобы закэшированное значение нельзя было изменить снаружи.
+@functools.lru_cache(maxsize=512)
+def _fallback_queries(low: str) -> tuple[str, ...]:
+    counts = _count_keywords(low)
+
+    # Основные категории продуктов: вес категории x число упоминаний её ключевых слов
+    scores = {}
+    for label, keywords in _QUERY_RULES:
+        hits = sum(counts[keyword] for keyword in keywords)
+        if hits:
+            scores[label] = _QUERY_WEIGHTS[label] * hits
+
+    # Если ничего специфического не найдено, используем базовые категории
+    if not scores:
+        return ("facial cleanser", "moisturizer", "sunscreen")
+
+    # Три самых приоритетных запроса; при равенстве сохраняется порядок правил
+    return tuple(sorted(scores, key=scores.get, reverse=True)[:3])
+
+
+@functools.lru_cache(maxsize=512)
+def _skin_profile(low: str) -> tuple[str, tuple[str, ...], tuple[str, ...], tuple[str, ...]]:
+    """(skin_type, concerns, deficiencies, excesses) по тексту сводки в нижнем регистре"""
+    hits = _scan_keywords(low)
+    skin_type = "combination"
+
+    if "oily" in hits and "dry" not in hits:
+        skin_type = "oily"
+    elif "dry" in hits and "oily" not in hits:
+        skin_type = "dry"
+    elif "normal" in hits:
+        skin_type = "normal"
+    elif "sensitive" in hits:
+        skin_type = "sensitive"
+
+    concerns = _apply_rules(_CONCERN_RULES, hits)
+
+    deficiencies = _apply_rules(_DEFICIENCY_RULES, hits)
+    if {"barrier", "compromised"} <= hits:
+        deficiencies.append("barrier function")
+    excesses = _apply_rules(_EXCESS_RULES, hits)
+
+    return skin_type, tuple(concerns), tuple(deficiencies), tuple(excesses)
+
+
+_RETRY_DELAY_RE = re.compile(r"^\s*(\d+(?:\.\d+)?)s?\s*$")
+
+
+def _server_retry_after(exc: genai_errors.APIError) -> float | None:
+    """Достаёт подсказку сервера о паузе: заголовок Retry-After или google.rpc.RetryInfo"""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    candidates = [headers.get("retry-after")] if headers is not None else []
+    details = getattr(exc, "details", None)
+    if isinstance(details, dict):
+        for item in (details.get("error") or {}).get("details") or []:
+            if isinstance(item, dict) and "retryDelay" in item:
+                candidates.append(item["retryDelay"])
+    for value in candidates:
+        match = _RETRY_DELAY_RE.match(str(value or ""))
+        if match:
+            return float(match.group(1))
+    return None
+
+
+def _retry_delay(exc: Exception, attempt: int, backoffs: List[float]) -> float | None:
+    """
+    Пауза перед следующей попыткой или None, если повторять бессмысленно.
+
+    429 — ждём не меньше, чем просит сервер; 5xx/408 — обычный backoff;
+    сетевые сбои — повторяем сразу; прочие 4xx (неверный запрос, ключ, права) — не повторяем.
+    """
+    backoff = backoffs[min(attempt, len(backoffs)) - 1]
+    if isinstance(exc, genai_errors.APIError):
+        if exc.code == 429:
+            return max(_server_retry_after(exc) or 0.0, backoff)
+        if exc.code == 408 or exc.code >= 500:
+            return backoff
+        return None
+    if isinstance(exc, httpx.TransportError):
+        return 0.0
+    return backoff
+
+
+# Незавершённые планирования по ключу сводки: параллельные одинаковые запросы ждут одну задачу
+_inflight_plans: Dict[str, asyncio.Task] = {}
+
+
+@functools.lru_cache(maxsize=4)
+def _get_genai_client(api_key: str | None) -> genai.Client:
+    """Один genai.Client на процесс: GeminiClient создаётся на каждую задачу"""
+    # SDK сам создаёт httpx-клиенты; задаём им те же лимиты keep-alive, что и у общего пула
+    return genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(
+            client_args={"limits": HTTP_LIMITS},
+            async_client_args={"limits": HTTP_LIMITS},
+        ),
+    )
+
+
 class GeminiClient:
     def __init__(self) -> None:
         if not settings.gemini_api_key:
@@ -57,192 +333,168 @@ class GeminiClient:
 
         # Create a central client (sync + async available via client.aio)
         # For Gemini Developer API, use api_key param
-        self.client = genai.Client(api_key=settings.gemini_api_key)
+        self.client = _get_genai_client(settings.gemini_api_key)
         self.model_name = settings.gemini_model
 
-        # create a Tool wrapper for function-calling usage
-        self.search_tool = types.Tool(function_declarations=[SEARCH_PRODUCTS_FUNCTION])
-
-        # Initialize product search client
-        self.product_search_client = ProductSearchClient()
+        # Shared product search client (one semaphore and connection pool per process)
+        self.product_search_client = product_search_client
 
     async def plan_with_tool(self, medgemma_summary: str, user_text: str | None) -> tuple[Dict[str, Any], List[Dict[str, Any]]]:
         """
         First stage: ask model to analyze medgemma_summary and call search_products multiple times.
-        We use multiple rounds of conversation to encourage multiple tool calls.
+        All tool calls come from a single Gemini turn and the searches run concurrently.
+        Products for near-identical summaries are served from the semantic plan cache.
         """
+        cache_text = f"{medgemma_summary[:2000]}\n{user_text or ''}"
+        low = medgemma_summary.lower()
+        cached_products = plan_cache.get(cache_text)
+        if cached_products is not None:
+            plan = self._create_plan_from_analysis(medgemma_summary, cached_products, "cached searches", low=low)
+            logger.info("[Gemini] Plan served from cache with %d products", len(cached_products))
+            return plan, cached_products
+
+        # Одинаковые запросы, пришедшие одновременно, разделяют одно планирование (single-flight)
+        key = hashlib.sha1(cache_text.encode("utf-8")).hexdigest()
+        task = _inflight_plans.get(key)
+        if task is None:
+            task = asyncio.create_task(self._collect_products(medgemma_summary, user_text, cache_text, low))
+            _inflight_plans[key] = task
+            task.add_done_callback(lambda _t, k=key: _inflight_plans.pop(k, None))
+            collected_products = await asyncio.shield(task)
+        else:
+            logger.info("[Gemini] Joining in-flight planning for identical summary")
+            collected_products = [dict(p) for p in await asyncio.shield(task)]
+
+        plan = self._create_plan_from_analysis(medgemma_summary, collected_products, "multiple focused searches", low=low)
+
+        logger.info("[Gemini] Plan created with %d products from multiple searches", len(collected_products))
+        return plan, collected_products
+
+    async def _collect_products(self, medgemma_summary: str, user_text: str | None, cache_text: str, low: str) -> List[Dict[str, Any]]:
+        """One Gemini tool-calling turn, then all searches concurrently; returns deduplicated products"""
         user_message = (
             f"Based on this MedGemma skin analysis, search for appropriate skincare products.\n\n"
             f"MedGemma Analysis:\n{medgemma_summary}\n\n"
             f"User note: {user_text or 'No additional notes'}\n\n"
-            f"Please call the search_products function multiple times (2-3 times) with specific, focused queries. "
+            f"Please call the search_products function multiple times (2-3 times) in this single response with specific, focused queries. "
             f"Each query should target a specific skin concern or product type (e.g., 'acne cleanser', 'anti-aging serum', 'moisturizer for dry skin')."
         )
 
         collected_products: List[Dict[str, Any]] = []
-        conversation_history = [user_message]
-        
-        # Пытаемся получить множественные вызовы через многоходовую беседу
-        max_rounds = 3
-        for round_num in range(max_rounds):
+
+        # Поиски идут с enrich=False: для подбора хватает name/url/snippet, цену (необязательную)
+        # берём из метаданных CSE и не ждём загрузки до 10 страниц магазинов на каждый запрос.
+        # Спекулятивно запускаем поиск по эвристическому запросу параллельно с ходом Gemini:
+        # если модель попросит тот же запрос (или дело дойдёт до fallback), результат уже будет готов
+        fallback_queries = self._generate_multiple_fallback_queries(medgemma_summary, low=low)
+        spec_query = fallback_queries[0]
+        spec_task = asyncio.create_task(self.product_search_client.search_products(query=spec_query, num=3, enrich=False))
+        spec_used = False
+
+        try:
+            # Один ход Gemini: с mode=ANY модель возвращает все вызовы search_products сразу
             attempts, response = 0, None
             backoffs = [1, 2, 4]
 
             while attempts < 3:
                 attempts += 1
                 try:
-                    # async call
                     response = await self.client.aio.models.generate_content(
                         model=self.model_name,
-                        contents=conversation_history[-1] if round_num == 0 else "Please make another search for a different skin concern from the analysis.",
-                        config=types.GenerateContentConfig(
-                            tools=[self.search_tool],
-                            temperature=0.1,
-                            max_output_tokens=1024,
-                        ),
+                        contents=user_message,
+                        config=_PLAN_CONFIG,
                     )
                     break
                 except Exception as e:
-                    logger.warning(f"[Gemini] planning round {round_num+1} attempt {attempts} failed: {e}")
-                    if attempts < 3:
-                        time.sleep(backoffs[attempts - 1])
+                    logger.warning("[Gemini] planning attempt %d failed: %s", attempts, e)
+                    delay = _retry_delay(e, attempts, backoffs)
+                    if delay is not None and attempts < 3:
+                        # Не блокируем event loop; джиттер разводит повторы параллельных задач
+                        await asyncio.sleep(delay * (1 + random.random() * 0.5))
                     else:
-                        if round_num == 0:  # Только первый раунд критичен
-                            raise
-                        else:
-                            logger.warning(f"[Gemini] Skipping round {round_num+1} due to errors")
-                            break
+                        raise
 
             if response is None:
-                if round_num == 0:
-                    raise Exception("Failed to get response from Gemini after 3 attempts")
-                continue
-
-            # Process function calls from this round
-            function_calls = getattr(response, "function_calls", None)
-            if function_calls:
-                for fc in function_calls:
-                    func_name = getattr(fc, "name", None)
-                    args = getattr(fc, "args", {}) or {}
-                    if func_name == "search_products":
-                        query = args.get("query", "")
-                        logger.info(f"[Gemini] Round {round_num+1} Tool call: search_products with query='{query}'")
-                        if query:
-                            try:
-                                products = await self.product_search_client.search_products(query=query, num=3)  # Меньше продуктов на запрос
-                                collected_products.extend(products)
-                            except Exception as e:
-                                logger.warning(f"[Gemini] Tool search_products failed in round {round_num+1}: {e}")
-
-            # Если модель не вызвала функции, добавляем подсказку для следующего раунда
-            if not function_calls and round_num < max_rounds - 1:
-                conversation_history.append("Please search for skincare products for another skin concern mentioned in the analysis.")
-
-        # Если все же не получили достаточно вызовов, делаем fallback множественные поиски
-        if len(collected_products) < 3:
-            fallback_queries = self._generate_multiple_fallback_queries(medgemma_summary)
-            logger.info(f"[Gemini] Using fallback queries: {fallback_queries}")
-            
-            # Выполняем параллельно несколько поисков
-            search_tasks = [self.product_search_client.search_products(query=q, num=2) for q in fallback_queries[:3]]
-            try:
-                fallback_results = await asyncio.gather(*search_tasks, return_exceptions=True)
-                for i, result in enumerate(fallback_results):
+                raise Exception("Failed to get response from Gemini after 3 attempts")
+
+            queries: List[str] = []
+            for fc in getattr(response, "function_calls", None) or []:
+                args = getattr(fc, "args", {}) or {}
+                query = (args.get("query") or "").strip()
+                if getattr(fc, "name", None) == "search_products" and query and query.lower() not in {q.lower() for q in queries}:
+                    logger.info("[Gemini] Tool call: search_products with query=%r", query)
+                    queries.append(query)
+
+            # Все поиски модели выполняем параллельно; спекулятивный результат переиспользуем
+            search_tasks = []
+            for q in queries[:3]:
+                if not spec_used and q.lower() == spec_query:
+                    logger.info("[Gemini] Reusing speculative search for %r", spec_query)
+                    spec_used = True
+                    search_tasks.append(spec_task)
+                else:
+                    search_tasks.append(self.product_search_client.search_products(query=q, num=3, enrich=False))  # Меньше продуктов на запрос
+            if search_tasks:
+                results = await asyncio.gather(*search_tasks, return_exceptions=True)
+                for q, result in zip(queries, results):
                     if isinstance(result, Exception):
-                        logger.warning(f"[Gemini] Fallback search {i+1} failed: {result}")
+                        logger.warning("[Gemini] Tool search_products failed for %r: %s", q, result)
                     else:
                         collected_products.extend(result)
-            except Exception as e:
-                logger.warning(f"[Gemini] Fallback searches failed: {e}")
 
-        # Убираем дубликаты по URL
+            # Если модель дала мало результатов, делаем fallback множественные поиски
+            if len(collected_products) < 3:
+                logger.info("[Gemini] Using fallback queries: %s", fallback_queries)
+
+                search_tasks = []
+                for q in fallback_queries[:3]:
+                    if q == spec_query and not spec_used:
+                        spec_used = True
+                        search_tasks.append(spec_task)
+                    else:
+                        search_tasks.append(self.product_search_client.search_products(query=q, num=2, enrich=False))
+                try:
+                    fallback_results = await asyncio.gather(*search_tasks, return_exceptions=True)
+                    for i, result in enumerate(fallback_results):
+                        if isinstance(result, Exception):
+                            logger.warning("[Gemini] Fallback search %d failed: %s", i + 1, result)
+                        else:
+                            collected_products.extend(result)
+                except Exception as e:
+                    logger.warning("[Gemini] Fallback searches failed: %s", e)
+        finally:
+            if not spec_used:
+                if not spec_task.done():
+                    spec_task.cancel()
+                elif not spec_task.cancelled():
+                    # Забираем исключение неиспользованного поиска, иначе asyncio пишет "Task exception was never retrieved"
+                    spec_task.exception()
+
+        # Убираем дубликаты по URL; останавливаемся, как только набрали 10 продуктов
         seen_urls = set()
         unique_products = []
         for product in collected_products:
-            if product.get('url') and product['url'] not in seen_urls:
-                seen_urls.add(product['url'])
-                unique_products.append(product)
-        
-        collected_products = unique_products[:10]  # Ограничиваем до 10 продуктов
+            url = product.get('url')
+            if not url or url in seen_urls:
+                continue
+            seen_urls.add(url)
+            unique_products.append(product)
+            if len(unique_products) == 10:
+                break
 
-        plan = self._create_plan_from_analysis(medgemma_summary, collected_products, "multiple focused searches")
+        collected_products = unique_products
 
-        logger.info(f"[Gemini] Plan created with {len(collected_products)} products from multiple searches")
-        return plan, collected_products
+        if collected_products:
+            plan_cache.put(cache_text, collected_products)
 
-    def _generate_multiple_fallback_queries(self, medgemma_summary: str) -> List[str]:
+        return collected_products
+
+    def _generate_multiple_fallback_queries(self, medgemma_summary: str, low: str | None = None) -> List[str]:
         """Генерирует несколько целенаправленных запросов на основе анализа кожи"""
-        low = medgemma_summary.lower()
-        queries = []
-
-        # Основные категории продуктов
-        if "blackhead" in low or "comedone" in low or "pore" in low:
-            queries.append("pore cleansing treatment")
-        if "dehydrat" in low or "dry" in low:
-            queries.append("hydrating moisturizer")
-        if "acne" in low or "pimple" in low or "pustule" in low:
-            queries.append("acne treatment serum")
-        if "aging" in low or "fine line" in low or "wrinkle" in low:
-            queries.append("anti-aging cream")
-        if "hyperpigmentation" in low or "dark spot" in low or "sun damage" in low:
-            queries.append("brightening serum")
-        if "inflam" in low or "redness" in low or "irritat" in low:
-            queries.append("soothing skincare")
-        if "oily" in low or "sebum" in low:
-            queries.append("oil control products")
-        if "sensitive" in low:
-            queries.append("gentle skincare")
-
-        # Если ничего специфического не найдено, используем базовые категории
-        if not queries:
-            queries = ["facial cleanser", "moisturizer", "sunscreen"]
-
-        # Возвращаем максимум 4 запроса
-        return queries[:4]
-
-    def _generate_fallback_query(self, medgemma_summary: str) -> str:
-        """Оставляем для совместимости, но теперь используется редко"""
-        queries = self._generate_multiple_fallback_queries(medgemma_summary)
-        return " ".join(queries[:2]) if queries else "skincare products routine"
-
-    def _create_plan_from_analysis(self, medgemma_summary: str, products: List[Dict[str, Any]], query: str) -> Dict[str, Any]:
-        low = medgemma_summary.lower()
-        skin_type = "combination"
-
-        if "oily" in low and "dry" not in low:
-            skin_type = "oily"
-        elif "dry" in low and "oily" not in low:
-            skin_type = "dry"
-        elif "normal" in low:
-            skin_type = "normal"
-        elif "sensitive" in low:
-            skin_type = "sensitive"
-
-        concerns = []
-        if "blackhead" in low or "comedone" in low:
-            concerns.append("blackheads and comedones")
-        if "dehydrat" in low:
-            concerns.append("dehydration")
-        if "acne" in low:
-            concerns.append("acne")
-        if "hyperpigmentation" in low:
-            concerns.append("hyperpigmentation")
-        if "aging" in low or "fine line" in low:
-            concerns.append("signs of aging")
-        if "inflam" in low or "redness" in low:
-            concerns.append("inflammation and redness")
-
-        deficiencies, excesses = [], []
-        if "dehydrat" in low or "dry" in low:
-            deficiencies.append("moisture")
-        if "dull" in low:
-            deficiencies.append("radiance")
-        if "barrier" in low and "compromised" in low:
-            deficiencies.append("barrier function")
-        if "oily" in low or "sebum" in low:
-            excesses.append("sebum production")
-        if "comedone" in low:
-            excesses.append("clogged pores")
+        return list(_fallback_queries(low if low is not None else medgemma_summary.lower()))
+
+    def _create_plan_from_analysis(self, medgemma_summary: str, products: List[Dict[str, Any]], query: str, low: str | None = None) -> Dict[str, Any]:
+        skin_type, concerns, deficiencies, excesses = _skin_profile(low if low is not None else medgemma_summary.lower())
 
         diagnosis = medgemma_summary.split("\n")[0] if medgemma_summary else "Skin analysis completed"
         if "Summary:" in diagnosis:
@@ -251,98 +503,185 @@ class GeminiClient:
         return {
             "skin_type": skin_type,
             "diagnosis": diagnosis[:500],
-            "concerns": concerns,
-            "deficiencies": deficiencies,
-            "excesses": excesses,
+            "concerns": list(concerns),
+            "deficiencies": list(deficiencies),
+            "excesses": list(excesses),
             "query": query,
             "need_search": True,
             "medgemma_analysis": medgemma_summary
         }
 
-    def finalize_with_products(self, planning_json: str, products_jsonl: str) -> Dict[str, Any]:
+    async def finalize_with_products(self, planning_json: str, products_jsonl: str) -> Dict[str, Any]:
         """
         Second stage: combine planning + product search results and ask model to produce a single JSON.
-        This is using the sync client.models.generate_content so it can be called from sync code.
+        Uses the async client so the event loop stays free while Gemini decodes.
+        If no products were found, a local template is returned without calling Gemini.
         """
-        # Create the response schema (you can keep using dict-based JSON schema; SDK accepts it)
-        schema = {
-            "type": "object",
-            "properties": {
-                "diagnosis": {"type": "string"},
-                "skin_type": {"type": "string"},
-                "explanation": {"type": "string"},
-                "routine_steps": {"type": "array", "items": {"type": "string"}},
-                "products": {
-                    "type": "array",
-                    "items": {
-                        "type": "object",
-                        "properties": {
-                            "name": {"type": "string"},
-                            "url": {"type": "string"},
-                            "price": {"type": "string"},
-                            "snippet": {"type": "string"},
-                            "image_url": {"type": "string"},
-                        },
-                        "required": ["name", "url"],
-                    },
-                },
-                "additional_recommendations": {"type": "string"},
-                "medgemma_summary": {"type": "string"},
-            },
-            "required": ["diagnosis", "skin_type", "explanation", "products", "medgemma_summary"],
-        }
+        plan = self._parse_json_object(planning_json)
+        products = self._parse_products(products_jsonl)
+        if not products:
+            logger.info("[Gemini] No products to finalize; returning local template")
+            return self._empty_products_response(plan)
+
+        prompt = self._finalize_prompt(planning_json, products)
+        cached = final_cache.get(prompt)
+        if cached is not None:
+            return cached
 
         attempts, resp = 0, None
         backoffs = [1, 2, 4]
 
-        prompt = f"Plan: {planning_json}\nProducts: {products_jsonl}"
-
         while attempts < 3:
             attempts += 1
             try:
-                resp = self.client.models.generate_content(
+                resp = await self.client.aio.models.generate_content(
                     model=self.model_name,
                     contents=prompt,
-                    config=types.GenerateContentConfig(
-                        temperature=0.1,
-                        max_output_tokens=2048,
-                        response_mime_type="application/json",
-                        response_schema=schema,
-                    ),
+                    config=_FINALIZE_CONFIG,
                 )
                 break
             except Exception as e:
-                logger.warning(f"[Gemini] finalize attempt {attempts} failed: {e}")
-                if attempts < 3:
-                    time.sleep(backoffs[attempts - 1])
+                logger.warning("[Gemini] finalize attempt %d failed: %s", attempts, e)
+                delay = _retry_delay(e, attempts, backoffs)
+                if delay is not None and attempts < 3:
+                    # Джиттер, как в plan и stream: параллельные finalize после 429 не повторяют хором
+                    await asyncio.sleep(delay * (1 + random.random() * 0.5))
                 else:
                     raise
 
         if not resp:
             return self._fallback_response("No response returned")
 
-        # Try to parse response.text (SDK exposes combined text via .text)
-        content_text = getattr(resp, "text", None)
-        if not content_text:
-            # Try to grab first candidate textual content as fallback
-            try:
-                candidate = resp.candidates[0]
-                content_text = getattr(candidate, "text", "") or ""
-            except Exception:
-                content_text = ""
+        # response_schema enforces JSON server-side; the SDK already parses it into resp.parsed
+        parsed = getattr(resp, "parsed", None)
+        if isinstance(parsed, dict):
+            final_cache.put(prompt, parsed)
+            return parsed
 
+        content_text = self._response_text(resp)
         if not content_text.strip():
             return self._fallback_response("Empty text content after parsing parts")
 
         try:
-            return json.loads(content_text)
-        except json.JSONDecodeError as e:
-            logger.warning(f"[Gemini] finalize JSON parse failed: {e}")
-            logger.warning(f"[Gemini] Raw response: {content_text[:1000]}...")
+            result = orjson.loads(content_text)
+        except orjson.JSONDecodeError as e:
+            logger.warning("[Gemini] finalize JSON parse failed: %s", e)
+            logger.warning("[Gemini] Raw response: %.1000s...", content_text)
             return self._fallback_response(f"JSON decode error: {str(e)}")
 
+        if isinstance(result, dict):
+            final_cache.put(prompt, result)
+        return result
+
+    async def stream_finalize_with_products(self, planning_json: str, products_jsonl: str) -> AsyncIterator[str]:
+        """
+        Streaming variant of finalize_with_products: yields raw JSON text chunks as Gemini decodes them,
+        so callers can publish partial output before the full response is ready.
+        Retries are only possible until the first chunk has been yielded.
+        """
+        plan = self._parse_json_object(planning_json)
+        products = self._parse_products(products_jsonl)
+        if not products:
+            logger.info("[Gemini] No products to finalize; returning local template")
+            yield orjson.dumps(self._empty_products_response(plan)).decode()
+            return
+
+        prompt = self._finalize_prompt(planning_json, products)
+        cached = final_cache.get(prompt)
+        if cached is not None:
+            yield orjson.dumps(cached).decode()
+            return
+
+        attempts = 0
+        backoffs = [1, 2, 4]
+
+        while attempts < 3:
+            attempts += 1
+            started = False
+            chunks: List[str] = []
+            try:
+                stream = await self.client.aio.models.generate_content_stream(
+                    model=self.model_name,
+                    contents=prompt,
+                    config=_FINALIZE_CONFIG,
+                )
+                async for chunk in stream:
+                    text = self._response_text(chunk)
+                    if text:
+                        started = True
+                        chunks.append(text)
+                        yield text
+                try:
+                    result = orjson.loads("".join(chunks))
+                except orjson.JSONDecodeError:
+                    result = None
+                if isinstance(result, dict):
+                    final_cache.put(prompt, result)
+                return
+            except Exception as e:
+                logger.warning("[Gemini] finalize stream attempt %d failed: %s", attempts, e)
+                delay = _retry_delay(e, attempts, backoffs)
+                if started or delay is None or attempts >= 3:
+                    raise
+                await asyncio.sleep(delay * (1 + random.random() * 0.5))
+
+    @staticmethod
+    def _response_text(resp: Any) -> str:
+        """Склеивает текстовые части первого кандидата одним join, пропуская function_call и thought-части"""
+        candidates = getattr(resp, "candidates", None) or []
+        content = getattr(candidates[0], "content", None) if candidates else None
+        texts = []
+        for part in getattr(content, "parts", None) or []:
+            if getattr(part, "function_call", None):
+                logger.warning("[Gemini] Unexpected function_call part in finalize response; skipping")
+            elif part.text and not getattr(part, "thought", False):
+                texts.append(part.text)
+        return "".join(texts)
+
+    @staticmethod
+    def _parse_json_object(raw: str) -> Dict[str, Any]:
+        try:
+            data = orjson.loads(raw) if raw else {}
+        except orjson.JSONDecodeError:
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    @staticmethod
+    def _finalize_prompt(planning_json: str, products: List[Dict[str, Any]]) -> str:
+        slim = [_slim_product(p) if "raw" not in p else p for p in products[:_FINALIZE_MAX_PRODUCTS]]
+        return f"Plan: {planning_json}\nProducts: {orjson.dumps(slim).decode()}"
+
+    @staticmethod
+    def _parse_products(raw: str) -> List[Dict[str, Any]]:
+        """Принимает как JSON-массив, так и JSONL (по объекту на строку)"""
+        raw = (raw or "").strip()
+        if not raw:
+            return []
+        try:
+            if raw.startswith("["):
+                return [p for p in orjson.loads(raw) if p]
+            return [orjson.loads(line) for line in raw.splitlines() if line.strip()]
+        except orjson.JSONDecodeError:
+            # Не можем разобрать — пусть решает модель
+            return [{"raw": raw}]
+
+    def _empty_products_response(self, plan: Dict[str, Any]) -> Dict[str, Any]:
+        concerns = plan.get("concerns") or []
+        explanation = "No products found for current query."
+        if concerns:
+            explanation += f" Main concerns: {', '.join(concerns)}."
+        return {
+            "diagnosis": plan.get("diagnosis", ""),
+            "skin_type": plan.get("skin_type", "unknown"),
+            "explanation": explanation,
+            "routine_steps": list(_DEFAULT_ROUTINE),
+            "products": [],
+            "additional_recommendations": _DEFAULT_TIPS,
+            "medgemma_summary": plan.get("medgemma_analysis", ""),
+        }
+
     def _fallback_response(self, reason: str) -> Dict[str, Any]:
-        logger.error(f"[Gemini] Fallback finalize response due to: {reason}")
+        logger.error("[Gemini] Fallback finalize response due to: %s", reason)
         return {
             "diagnosis": "Analysis failed",
             "skin_type": "unknown",
@@ -4,6 +4,10 @@ from dataclasses import dataclass, field
 import uuid
 import time
 from enum import Enum
+
+import orjson
+
+from app.config import settings
 from app.utils.logging import get_logger
 
 logger = get_logger("jobs")
@@ -26,45 +30,176 @@ class JobRecord:
     error: Optional[str] = None
 
 
-class JobManager:
-    def __init__(self) -> None:
+class InMemoryJobBackend:
+    """Хранилище задач в памяти процесса (один воркер); записи старше TTL вычищаются"""
+
+    def __init__(self, ttl_seconds: int) -> None:
+        self.ttl_seconds = ttl_seconds
         self._jobs: Dict[str, JobRecord] = {}
 
-    def create(self) -> JobRecord:
-        job_id = str(uuid.uuid4())
-        rec = JobRecord(id=job_id)
-        self._jobs[job_id] = rec
-        logger.info(f"Job created id={job_id}")
-        return rec
+    def _evict_expired(self) -> None:
+        cutoff = time.time() - self.ttl_seconds
+        expired = [job_id for job_id, rec in self._jobs.items() if rec.updated_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
 
-    def get(self, job_id: str) -> Optional[JobRecord]:
-        return self._jobs.get(job_id)
+    async def create(self, rec: JobRecord) -> None:
+        self._evict_expired()
+        self._jobs[rec.id] = rec
 
-    def update_progress(self, job_id: str, progress: Dict[str, Any]) -> None:
+    async def get(self, job_id: str) -> Optional[JobRecord]:
         rec = self._jobs.get(job_id)
-        if not rec:
-            return
-        rec.progress.update(progress)
-        rec.updated_at = time.time()
-        logger.info(f"Job {job_id} progress updated keys={list(progress.keys())}")
+        if rec and rec.updated_at < time.time() - self.ttl_seconds:
+            del self._jobs[job_id]
+            return None
+        return rec
 
-    def complete(self, job_id: str, result: Dict[str, Any]) -> None:
+    # Обновления выполняются в одном event loop без await внутри, поэтому гонок нет
+    async def update_progress(self, job_id: str, progress: Dict[str, Any]) -> bool:
         rec = self._jobs.get(job_id)
         if not rec:
-            return
-        rec.status = JobStatus.done
-        rec.result = result
+            return False
+        rec.progress.update(progress)
         rec.updated_at = time.time()
-        logger.info(f"Job {job_id} completed")
+        return True
 
-    def fail(self, job_id: str, error: str) -> None:
+    async def finish(self, job_id: str, status: JobStatus, result: Optional[Dict[str, Any]], error: Optional[str]) -> bool:
         rec = self._jobs.get(job_id)
         if not rec:
-            return
-        rec.status = JobStatus.failed
+            return False
+        rec.status = status
+        rec.result = result
         rec.error = error
         rec.updated_at = time.time()
-        logger.warning(f"Job {job_id} failed: {error}")
+        return True
+
+
+# Записи выполняются только если job:{id} существует: иначе после истечения TTL
+# HSET создал бы неполный hash без status/created_at, и get() падал бы на нём.
+# KEYS: job:{id}, job:{id}:progress; ARGV: updated_at, ttl, пары поле/значение
+_UPDATE_PROGRESS_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+if #ARGV > 2 then
+    redis.call('HSET', KEYS[2], unpack(ARGV, 3))
+end
+redis.call('HSET', KEYS[1], 'updated_at', ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# KEYS: job:{id}, job:{id}:progress; ARGV: ttl, пары поле/значение
+_FINISH_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+return 1
+"""
+
+
+class RedisJobBackend:
+    """
+    Хранилище задач в Redis, общее для всех воркеров.
+
+    job:{id} — hash с полями записи, job:{id}:progress — hash с частичными результатами.
+    Частичные обновления пишутся через HSET по полям, поэтому параллельные шаги не затирают друг друга.
+    """
+
+    def __init__(self, url: str, ttl_seconds: int) -> None:
+        import redis.asyncio as redis
+
+        self.ttl_seconds = ttl_seconds
+        self._redis = redis.from_url(url)
+        self._update_progress_script = self._redis.register_script(_UPDATE_PROGRESS_LUA)
+        self._finish_script = self._redis.register_script(_FINISH_LUA)
+
+    @staticmethod
+    def _key(job_id: str) -> str:
+        return f"job:{job_id}"
+
+    async def create(self, rec: JobRecord) -> None:
+        key = self._key(rec.id)
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.hset(key, mapping={
+                "status": rec.status.value,
+                "created_at": rec.created_at,
+                "updated_at": rec.updated_at,
+            })
+            pipe.expire(key, self.ttl_seconds)
+            await pipe.execute()
+
+    async def get(self, job_id: str) -> Optional[JobRecord]:
+        key = self._key(job_id)
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(key)
+            pipe.hgetall(f"{key}:progress")
+            fields, progress = await pipe.execute()
+        if not fields:
+            return None
+        result = fields.get(b"result")
+        error = fields.get(b"error")
+        return JobRecord(
+            id=job_id,
+            status=JobStatus(fields[b"status"].decode()),
+            created_at=float(fields[b"created_at"]),
+            updated_at=float(fields[b"updated_at"]),
+            progress={k.decode(): orjson.loads(v) for k, v in progress.items()},
+            result=orjson.loads(result) if result else None,
+            error=error.decode() if error else None,
+        )
+
+    async def update_progress(self, job_id: str, progress: Dict[str, Any]) -> bool:
+        key = self._key(job_id)
+        args: list[Any] = [time.time(), self.ttl_seconds]
+        for k, v in progress.items():
+            args += (k, orjson.dumps(v))
+        # Один RTT; запись только если job:{id} ещё существует
+        return bool(await self._update_progress_script(keys=[key, f"{key}:progress"], args=args))
+
+    async def finish(self, job_id: str, status: JobStatus, result: Optional[Dict[str, Any]], error: Optional[str]) -> bool:
+        key = self._key(job_id)
+        args: list[Any] = [self.ttl_seconds, "status", status.value, "updated_at", time.time()]
+        if result is not None:
+            args += ("result", orjson.dumps(result))
+        if error is not None:
+            args += ("error", error)
+        return bool(await self._finish_script(keys=[key, f"{key}:progress"], args=args))
+
+
+class JobManager:
+    def __init__(self) -> None:
+        if settings.redis_url:
+            self._backend = RedisJobBackend(settings.redis_url, settings.job_ttl_seconds)
+            logger.info("Job storage: redis")
+        else:
+            self._backend = InMemoryJobBackend(settings.job_ttl_seconds)
+
+    async def create(self) -> JobRecord:
+        job_id = str(uuid.uuid4())
+        rec = JobRecord(id=job_id)
+        await self._backend.create(rec)
+        logger.info("Job created id=%s", job_id)
+        return rec
+
+    async def get(self, job_id: str) -> Optional[JobRecord]:
+        return await self._backend.get(job_id)
+
+    async def update_progress(self, job_id: str, progress: Dict[str, Any]) -> None:
+        if await self._backend.update_progress(job_id, progress):
+            logger.debug("Job %s progress updated keys=%s", job_id, list(progress))
+
+    async def complete(self, job_id: str, result: Dict[str, Any]) -> None:
+        if await self._backend.finish(job_id, JobStatus.done, result, None):
+            logger.info("Job %s completed", job_id)
+
+    async def fail(self, job_id: str, error: str) -> None:
+        if await self._backend.finish(job_id, JobStatus.failed, None, error):
+            logger.warning("Job %s failed: %s", job_id, error)
 
 # Global manager instance
 job_manager = JobManager()
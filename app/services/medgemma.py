@@ -1,6 +1,14 @@
 from __future__ import annotations
+from typing import Any, Dict, List, Tuple
+import asyncio
+import base64
+import io
+import random
+import threading
+import openai
 from PIL import Image
-from transformers import pipeline, AutoProcessor, AutoModelForImageTextToText
+from transformers import pipeline, AutoProcessor, AutoModelForImageTextToText, BitsAndBytesConfig
+from app.utils.http import HTTP_LIMITS
 from app.utils.logging import get_logger
 from app.config import settings
 import torch
@@ -8,46 +16,276 @@ import torch
 logger = get_logger("medgemma")
 
 
+_DTYPES = {
+    "bf16": torch.bfloat16,
+    "bfloat16": torch.bfloat16,
+    "fp16": torch.float16,
+    "float16": torch.float16,
+    "fp32": torch.float32,
+    "float32": torch.float32,
+}
+
+
+def _pick_dtype() -> torch.dtype:
+    """
+    dtype весов по settings.torch_dtype; для "auto" — по железу.
+    bf16 без аппаратной поддержки эмулируется и в разы медленнее fp32 (CPU без AVX512-BF16, GPU до Ampere)
+    """
+    requested = (settings.torch_dtype or "auto").strip().lower()
+    if requested in _DTYPES:
+        return _DTYPES[requested]
+    if requested != "auto":
+        logger.warning("[MedGemma] Unknown TORCH_DTYPE=%r; picking dtype by hardware", requested)
+    if torch.cuda.is_available():
+        major, _ = torch.cuda.get_device_capability()
+        return torch.bfloat16 if major >= 8 else torch.float16
+    is_cpu_bf16 = getattr(torch.cpu, "_is_avx512_bf16_supported", None)
+    if is_cpu_bf16 is not None and is_cpu_bf16():
+        return torch.bfloat16
+    return torch.float32
+
+
+def _quantization_config() -> BitsAndBytesConfig | None:
+    """bitsandbytes-квантование языковой части по settings.medgemma_quantization; vision tower остаётся в bf16"""
+    mode = (settings.medgemma_quantization or "none").strip().lower()
+    if mode == "int8":
+        return BitsAndBytesConfig(
+            load_in_8bit=True,
+            llm_int8_skip_modules=["vision_tower", "multi_modal_projector", "lm_head"],
+        )
+    if mode == "int4":
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=_pick_dtype(),
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_use_double_quant=True,
+            llm_int8_skip_modules=["vision_tower", "multi_modal_projector", "lm_head"],
+        )
+    if mode not in {"", "none"}:
+        logger.warning("[MedGemma] Unknown MEDGEMMA_QUANTIZATION=%r; loading unquantized", mode)
+    return None
+
+
+def _use_vllm() -> bool:
+    return (settings.medgemma_backend or "").strip().lower() == "vllm"
+
+
+_vllm_client: openai.AsyncOpenAI | None = None
+
+
+def _get_vllm_client() -> openai.AsyncOpenAI:
+    global _vllm_client
+    if _vllm_client is None:
+        _vllm_client = openai.AsyncOpenAI(
+            base_url=settings.medgemma_vllm_base_url,
+            api_key=settings.vllm_api_key,
+            max_retries=0,  # повторы делаем сами, с джиттером
+            # Тот же размер пула, что и у остальных исходящих клиентов; таймауты SDK по умолчанию
+            http_client=openai.DefaultAsyncHttpxClient(limits=HTTP_LIMITS),
+        )
+    return _vllm_client
+
+
+async def close_vllm_client() -> None:
+    global _vllm_client
+    if _vllm_client is not None:
+        await _vllm_client.close()
+    _vllm_client = None
+
+
+def _prepare_image(image: Image.Image, size: Tuple[int, int]) -> Image.Image:
+    # Процессор всё равно приводит картинку к нативному разрешению; уменьшаем заранее,
+    # чтобы не гонять препроцессинг по полноразмерному снимку
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if image.size != size:
+        image = image.resize(size, Image.Resampling.BILINEAR, reducing_gap=3.0)
+    return image
+
+
+def _encode_image(image: Image.Image) -> str:
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=90)
+    return base64.b64encode(buf.getvalue()).decode("ascii")
+
+
+# Промпты по режимам собираются один раз при импорте; меняется только пользовательский контекст.
+_BASIC_SYSTEM = (
+    "You are a professional dermatologist. Provide a concise, user-friendly assessment.\n"
+    "Return exactly two labeled sections in English:\n"
+    "Summary: a brief 1-2 sentence overview of the skin condition.\n"
+    "Description (basic): a short paragraph (3-6 sentences) focusing on key observations and main concerns."
+)
+_BASIC_USER = "Please analyze this skin image. Keep it concise and approachable.\n"
+_BASIC_USER_CONTEXT = "\nAdditional context from user: {}\nPlease consider this information in your analysis.\n"
+_BASIC_USER_SUFFIX = "Respond using the two sections: 'Summary:' and 'Description (basic):'."
+
+_EXTENDED_SYSTEM = (
+    """You are an expert dermatologist. 
+Provide a detailed analysis of the skin condition using professional terminology. 
+Focus on:
+- Skin type and texture
+- Hydration levels and barrier function
+- Sebum production and pore condition
+- Presence of any lesions, inflammation, or acne
+- Pigmentation and color uniformity
+- Signs of aging or photodamage
+- Visible blood vessels or redness
+- Any abnormal formations or concerning features"""
+)
+_EXTENDED_USER = (
+    """Please analyze this skin image in detail. 
+Describe all visible characteristics and potential concerns.
+Include both surface-level observations and potential underlying conditions.
+Use medical terminology where appropriate, but ensure the description remains understandable.
+Be specific about locations and severity of any issues observed."""
+)
+_EXTENDED_USER_CONTEXT = "\n\nAdditional context from user: {}\nPlease address the user's specific concerns and questions in your analysis."
+_EXTENDED_USER_SUFFIX = "\nRespond using the two sections: 'Summary:' and 'Description (extended):'."
+
+# mode -> (system content, user prompt, шаблон контекста, окончание, готовая часть без контекста)
+_PROMPTS = {
+    mode: (
+        [{"type": "text", "text": system}],
+        user,
+        context,
+        suffix,
+        {"type": "text", "text": user + suffix},
+    )
+    for mode, system, user, context, suffix in (
+        ("basic", _BASIC_SYSTEM, _BASIC_USER, _BASIC_USER_CONTEXT, _BASIC_USER_SUFFIX),
+        ("extended", _EXTENDED_SYSTEM, _EXTENDED_USER, _EXTENDED_USER_CONTEXT, _EXTENDED_USER_SUFFIX),
+    )
+}
+
+def _part_text(part: Any) -> str:
+    if not isinstance(part, dict):
+        return ""
+    content = part.get("content")
+    if isinstance(content, str):
+        return content
+    text = part.get("text")
+    return text if isinstance(text, str) else ""
+
+
+def _extract_text(generated: Any) -> str:
+    """generated_text пайплайна: строка или список сообщений/частей с полями content/text"""
+    if isinstance(generated, str):
+        return generated.strip()
+    if not isinstance(generated, list):
+        return ""
+    # Один проход: strip каждой части один раз, пустые пропускаем
+    return "\n".join(text for text in (_part_text(part).strip() for part in generated) if text)
+
 class MedGemmaService:
     _instance = None
     _pipe = None
+    # Очередь micro-batching: (messages, future); один воркер прогоняет пачку за один вызов pipeline
+    _queue: asyncio.Queue | None = None
+    _worker: asyncio.Task | None = None
+    _lock = threading.Lock()
+    # Нативное разрешение vision tower; уточняется по image_processor при загрузке
+    image_size: Tuple[int, int] = (896, 896)
 
     def __new__(cls):
+        # Double-checked locking: параллельные первые запросы не должны загрузить ~8 GB весов дважды
         if cls._instance is None:
-            cls._instance = super(MedGemmaService, cls).__new__(cls)
+            with cls._lock:
+                if cls._instance is None:
+                    instance = super(MedGemmaService, cls).__new__(cls)
+                    # С vLLM-бэкендом веса живут в отдельном сервере, локально ничего не грузим
+                    if not _use_vllm():
+                        cls._load()
+                    cls._instance = instance
+        return cls._instance
 
-            model_id = "google/medgemma-4b-it"
+    @classmethod
+    def _load(cls) -> None:
+        model_id = settings.medgemma_model
+        torch_dtype = _pick_dtype()
+        logger.info("[MedGemma] Loading weights in %s", torch_dtype)
 
-            # Map dtype from settings
-            dtype_map = {
-                "bf16": torch.bfloat16,
-                "bfloat16": torch.bfloat16,
-                "fp16": torch.float16,
-                "float16": torch.float16,
-                "fp32": torch.float32,
-                "float32": torch.float32,
-            }
-            # torch_dtype = dtype_map.get(settings.dtype.lower(), "auto")
+        load_kwargs = {"torch_dtype": torch_dtype, "device_map": settings.device_map, "low_cpu_mem_usage": True}
+        quantization_config = _quantization_config()
+        if quantization_config is not None:
+            load_kwargs["quantization_config"] = quantization_config
+            logger.info("[MedGemma] Loading with %s quantization", settings.medgemma_quantization)
 
+        # FlashAttention-2 не гоняет полную матрицу QK^T через HBM; без flash-attn откатываемся на SDPA
+        try:
             model = AutoModelForImageTextToText.from_pretrained(
                 model_id,
-                torch_dtype="auto",
-                device_map="auto",
+                attn_implementation="flash_attention_2",
+                **load_kwargs,
             )
-            # Try to use fast processor if available
-            try:
-                processor = AutoProcessor.from_pretrained(model_id, use_fast=True)
-            except TypeError:
-                processor = AutoProcessor.from_pretrained(model_id)
-
-            cls._pipe = pipeline(
-                "image-text-to-text",
-                model=model,
-                processor=processor,
-                do_sample=False,
+        except (ImportError, ValueError) as e:
+            logger.warning("[MedGemma] flash_attention_2 unavailable (%s); falling back to sdpa", e)
+            model = AutoModelForImageTextToText.from_pretrained(
+                model_id,
+                attn_implementation="sdpa",
+                **load_kwargs,
             )
+        # Фактический бэкенд внимания, чтобы молчаливый откат на eager был виден в логах
+        logger.info("[MedGemma] Attention implementation: %s", getattr(model.config, '_attn_implementation', 'unknown'))
 
-        return cls._instance
+        if settings.medgemma_compile:
+            # Статический KV-кэш фиксирует формы тензоров на шаге декодирования, поэтому
+            # CUDA graphs из reduce-overhead переиспользуются между токенами и запросами
+            model.generation_config.cache_implementation = "static"
+            # Кэш скомпилированных графов на диске: рестарт не платит за компиляцию заново
+            torch._inductor.config.fx_graph_cache = True
+            # Компиляция убирает Python-диспетчеризацию на каждый токен; первый вызов платит за компиляцию
+            model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False)
+            logger.info("[MedGemma] torch.compile enabled (mode=reduce-overhead, static KV cache)")
+
+        # Try to use fast processor if available
+        try:
+            processor = AutoProcessor.from_pretrained(model_id, use_fast=True)
+        except TypeError:
+            processor = AutoProcessor.from_pretrained(model_id)
+
+        size = getattr(getattr(processor, "image_processor", None), "size", None) or {}
+        if size.get("width") and size.get("height"):
+            cls.image_size = (size["width"], size["height"])
+
+        # Для батчевой генерации decoder-only модели нужен left padding
+        tokenizer = getattr(processor, "tokenizer", None)
+        if tokenizer is not None:
+            tokenizer.padding_side = "left"
+            # Останавливаемся сразу на <end_of_turn>, а не только на <eos>; pad задаём явно для батчей
+            end_of_turn_id = tokenizer.convert_tokens_to_ids("<end_of_turn>")
+            eos_ids = model.generation_config.eos_token_id
+            eos_ids = list(eos_ids) if isinstance(eos_ids, (list, tuple)) else [eos_ids] if eos_ids is not None else []
+            if isinstance(end_of_turn_id, int) and end_of_turn_id != tokenizer.unk_token_id and end_of_turn_id not in eos_ids:
+                eos_ids.append(end_of_turn_id)
+            if eos_ids:
+                model.generation_config.eos_token_id = eos_ids
+            if tokenizer.pad_token_id is not None:
+                model.generation_config.pad_token_id = tokenizer.pad_token_id
+
+        cls._pipe = pipeline(
+            "image-text-to-text",
+            model=model,
+            processor=processor,
+            do_sample=False,
+        )
+
+        if settings.medgemma_compile:
+            cls._warmup()
+
+    @classmethod
+    def _warmup(cls) -> None:
+        """Короткая генерация на пустой картинке: компиляция и захват CUDA graphs происходят до первого запроса"""
+        messages = [
+            {"role": "system", "content": _PROMPTS["basic"][0]},
+            {"role": "user", "content": [_PROMPTS["basic"][4], {"type": "image", "image": Image.new("RGB", cls.image_size)}]},
+        ]
+        try:
+            with torch.inference_mode():
+                cls._pipe(text=messages, max_new_tokens=8)
+            logger.info("[MedGemma] Compiled model warmed up")
+        except Exception as e:
+            logger.warning("[MedGemma] Compile warmup failed: %s", e)
 
     @classmethod
     async def analyze_image(cls, image: Image.Image, mode: str = "extended", user_text: str | None = None) -> str:
@@ -62,104 +300,174 @@ class MedGemmaService:
         Returns:
             Текстовый анализ изображения
         """
-        if cls._pipe is None:
-            cls()
+        if cls._instance is None:
+            # Обычно модель уже загружена на старте; загрузку в потоке не блокирует event loop
+            await asyncio.to_thread(cls)
 
         mode_norm = (mode or "extended").strip().lower()
         if mode_norm not in {"basic", "extended"}:
             mode_norm = "extended"
 
-        # Build messages based on requested mode
-        if mode_norm == "basic":
-            prompt_system = (
-                "You are a professional dermatologist. Provide a concise, user-friendly assessment.\n"
-                "Return exactly two labeled sections in English:\n"
-                "Summary: a brief 1-2 sentence overview of the skin condition.\n"
-                "Description (basic): a short paragraph (3-6 sentences) focusing on key observations and main concerns."
-            )
-            
-            # Базовый промпт для пользователя
-            prompt_user = "Please analyze this skin image. Keep it concise and approachable.\n"
-            
-            # Добавляем пользовательский текст если есть
-            if user_text and user_text.strip():
-                prompt_user += f"\nAdditional context from user: {user_text.strip()}\n"
-                prompt_user += "Please consider this information in your analysis.\n"
-            
-            prompt_user += "Respond using the two sections: 'Summary:' and 'Description (basic):'."
-            
-        else:  # extended
-            prompt_system = (
-                """You are an expert dermatologist. 
-Provide a detailed analysis of the skin condition using professional terminology. 
-Focus on:
-- Skin type and texture
-- Hydration levels and barrier function
-- Sebum production and pore condition
-- Presence of any lesions, inflammation, or acne
-- Pigmentation and color uniformity
-- Signs of aging or photodamage
-- Visible blood vessels or redness
-- Any abnormal formations or concerning features"""                          
-            )
-            
-            prompt_user = (
-                """Please analyze this skin image in detail. 
-Describe all visible characteristics and potential concerns.
-Include both surface-level observations and potential underlying conditions.
-Use medical terminology where appropriate, but ensure the description remains understandable.
-Be specific about locations and severity of any issues observed."""
-            )
-            
-            # Добавляем пользовательский текст если есть
-            if user_text and user_text.strip():
-                prompt_user += f"\n\nAdditional context from user: {user_text.strip()}"
-                prompt_user += "\nPlease address the user's specific concerns and questions in your analysis."
-            
-            prompt_user += "\nRespond using the two sections: 'Summary:' and 'Description (extended):'."
-
-        logger.info(f"[MedGemma] Mode: {mode_norm}")
+        system_content, user_base, user_context, user_suffix, user_default = _PROMPTS[mode_norm]
+        # Без пользовательского текста промпт неизменен — используем заранее собранную часть
         if user_text and user_text.strip():
-            logger.info(f"[MedGemma] User text provided: {user_text[:100]}...")
-        logger.info(f"[MedGemma] Image size: {image.size}")
+            user_part = {"type": "text", "text": user_base + user_context.format(user_text.strip()) + user_suffix}
+        else:
+            user_part = user_default
+
+        max_new_tokens = (
+            settings.medgemma_basic_max_new_tokens if mode_norm == "basic" else settings.medgemma_max_new_tokens
+        )
+
+        logger.info("[MedGemma] Mode: %s image size: %s", mode_norm, image.size)
+        if user_text and user_text.strip():
+            logger.info("[MedGemma] User text provided: %.100s...", user_text)
+
+        # Ресайз — CPU-работа: в потоке он перекрывается с генерацией предыдущей пачки
+        image = await asyncio.to_thread(_prepare_image, image, cls.image_size)
+
+        if _use_vllm():
+            response = await cls._analyze_remote(system_content[0]["text"], user_part["text"], image, max_new_tokens)
+            logger.info("[MedGemma] Output: %s", response)
+            return response
 
         messages = [
-            {
-                "role": "system",
-                "content": [{"type": "text", "text": prompt_system}]
-            },
+            {"role": "system", "content": system_content},
+            {"role": "user", "content": [user_part, {"type": "image", "image": image}]},
+        ]
+
+        response = await cls._submit(messages, max_new_tokens)
+        logger.info("[MedGemma] Output: %s", response)
+        return response
+
+    @classmethod
+    async def _analyze_remote(cls, system_text: str, user_text: str, image: Image.Image, max_new_tokens: int) -> str:
+        """Генерация через OpenAI-совместимый vLLM: PagedAttention и continuous batching на стороне сервера"""
+        image_b64 = await asyncio.to_thread(_encode_image, image)
+        messages = [
+            {"role": "system", "content": system_text},
             {
                 "role": "user",
                 "content": [
-                    {"type": "text", "text": prompt_user},
-                    {"type": "image", "image": image}
-                ]
-            }
+                    {"type": "text", "text": user_text},
+                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}},
+                ],
+            },
         ]
 
-        output = cls._pipe(text=messages, max_new_tokens=settings.medgemma_max_new_tokens)
-        generated = output[0].get("generated_text")
-        response = ""
-        
-        # Case 1: generated_text is a plain string
-        if isinstance(generated, str):
-            response = generated.strip()
-        # Case 2: list-of-dicts with content fields
-        elif isinstance(generated, list):
-            # Find last text chunk or join all text contents
-            texts = []
-            for part in generated:
-                if isinstance(part, dict):
-                    if "content" in part and isinstance(part["content"], str):
-                        texts.append(part["content"]) 
-                    elif "text" in part and isinstance(part["text"], str):
-                        texts.append(part["text"]) 
-            response = "\n".join([t.strip() for t in texts if t and t.strip()])
-        else:
-            response = ""
-            
-        logger.info(f"[MedGemma] Output: {response}")
-        return response
+        attempts = 0
+        backoffs = [1, 2, 4]
+        while True:
+            attempts += 1
+            try:
+                completion = await _get_vllm_client().chat.completions.create(
+                    model=settings.medgemma_model,
+                    messages=messages,
+                    max_tokens=max_new_tokens,
+                    temperature=0.0,
+                )
+                return (completion.choices[0].message.content or "").strip()
+            except (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError) as e:
+                logger.warning("[MedGemma] vLLM attempt %d failed: %s", attempts, e)
+                if attempts >= 3:
+                    raise
+                await asyncio.sleep(backoffs[attempts - 1] * (1 + random.random() * 0.5))
+
+    @classmethod
+    def start_batch_worker(cls) -> None:
+        """Запускает воркер micro-batching в текущем event loop (вызывается на старте приложения)"""
+        if cls._worker is None or cls._worker.done():
+            cls._queue = asyncio.Queue()
+            cls._worker = asyncio.create_task(cls._batch_worker())
+
+    @classmethod
+    async def stop_batch_worker(cls) -> None:
+        worker, queue = cls._worker, cls._queue
+        cls._worker = cls._queue = None
+        if worker is None:
+            return
+        worker.cancel()
+        try:
+            await worker
+        except asyncio.CancelledError:
+            pass
+        # Запросы, не попавшие в пачку, завершаем ошибкой, чтобы задачи не висели
+        while queue is not None and not queue.empty():
+            *_, future = queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("MedGemma service is shutting down"))
+
+    @classmethod
+    async def _submit(cls, messages: List[Dict[str, Any]], max_new_tokens: int) -> str:
+        cls.start_batch_worker()
+        future = asyncio.get_running_loop().create_future()
+        await cls._queue.put((messages, max_new_tokens, future))
+        return await future
+
+    @classmethod
+    async def _batch_worker(cls) -> None:
+        """Собирает до MEDGEMMA_MAX_BATCH_SIZE запросов за окно MEDGEMMA_BATCH_WAIT_MS и генерирует их одним проходом"""
+        queue = cls._queue
+        loop = asyncio.get_running_loop()
+        while True:
+            batch: List[Tuple[List[Dict[str, Any]], int, asyncio.Future]] = [await queue.get()]
+            try:
+                deadline = loop.time() + settings.medgemma_batch_wait_ms / 1000
+                while len(batch) < settings.medgemma_max_batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+                batch = [item for item in batch if not item[-1].cancelled()]
+                if not batch:
+                    continue
+                # Пачку делим по лимиту токенов, чтобы basic не генерировал с бюджетом extended;
+                # группы с меньшим лимитом идут первыми
+                groups: Dict[int, List[Tuple[List[Dict[str, Any]], int, asyncio.Future]]] = {}
+                for item in batch:
+                    groups.setdefault(item[1], []).append(item)
+                for max_new_tokens in sorted(groups):
+                    group = groups[max_new_tokens]
+                    logger.info("[MedGemma] Running batch of %d (max_new_tokens=%d)", len(group), max_new_tokens)
+                    try:
+                        # Генерация синхронная и тяжёлая — выносим из event loop
+                        responses = await asyncio.to_thread(
+                            cls._generate_batch,
+                            [messages for messages, _, _ in group],
+                            max_new_tokens,
+                        )
+                    except Exception as e:
+                        for *_, future in group:
+                            if not future.done():
+                                future.set_exception(e)
+                        continue
+                    for (*_, future), response in zip(group, responses):
+                        if not future.done():
+                            future.set_result(response)
+            except asyncio.CancelledError:
+                # Пачка уже вынута из очереди и stop_batch_worker её не увидит — завершаем её здесь
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(RuntimeError("MedGemma service is shutting down"))
+                raise
+
+    @classmethod
+    def _generate_batch(cls, batch: List[List[Dict[str, Any]]], max_new_tokens: int) -> List[str]:
+        outputs = cls._pipe(
+            text=batch,
+            max_new_tokens=max_new_tokens,
+            batch_size=len(batch),
+            # Только новые токены: pipeline режет вывод по длине входа, без повторной сборки всего диалога
+            return_full_text=False,
+        )
+        # Для списка диалогов pipeline возвращает по списку кандидатов на каждый диалог
+        return [cls._extract_response(out[0] if isinstance(out, list) else out) for out in outputs]
 
+    @staticmethod
+    def _extract_response(output: Dict[str, Any]) -> str:
+        return _extract_text(output.get("generated_text"))
 
-medgemma_service = MedGemmaService()
\ No newline at end of file
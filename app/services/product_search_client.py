@@ -1,6 +1,10 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
+from collections import OrderedDict
+import asyncio
+import time
 import httpx
 from app.config import settings
+from app.utils.http import get_http_client
 from app.utils.logging import get_logger
 
 
@@ -11,15 +15,39 @@ class ProductSearchClient:
     def __init__(self, base_url: str | None = None):
         self.base_url = (base_url or settings.product_search_base_url).rstrip("/")
         self.timeout = httpx.Timeout(15.0)
-        logger.info(f"[DEBUG] Initialized client with base_url: {self.base_url}")
+        # Ограничиваем число одновременных поисков со всех задач, чтобы всплеск не упирался в rate limit
+        self._semaphore = asyncio.Semaphore(settings.product_search_concurrency)
+        # (query, num) -> (expires_at, products); запросы от модели сильно повторяются между сессиями
+        self._cache: OrderedDict[Tuple[str, int, bool], Tuple[float, List[Dict[str, Any]]]] = OrderedDict()
+        self._cache_ttl = settings.product_search_cache_ttl_seconds
+        self._cache_max_entries = settings.product_search_cache_max_entries
 
-    async def search_products(self, query: str, num: int = 10) -> List[Dict[str, Any]]:
+    def _cache_get(self, key: Tuple[str, int, bool]) -> Optional[List[Dict[str, Any]]]:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return [dict(p) for p in entry[1]]
+
+    def _cache_put(self, key: Tuple[str, int, bool], products: List[Dict[str, Any]]) -> None:
+        if self._cache_ttl <= 0 or self._cache_max_entries <= 0:
+            return
+        self._cache[key] = (time.monotonic() + self._cache_ttl, [dict(p) for p in products])
+        self._cache.move_to_end(key)
+        while len(self._cache) > self._cache_max_entries:
+            self._cache.popitem(last=False)
+
+    async def search_products(self, query: str, num: int = 10, enrich: bool = True) -> List[Dict[str, Any]]:
         """
         Поиск продуктов через внешний Product Search Service
 
         Args:
             query: Поисковый запрос
             num: Количество результатов
+            enrich: Догружать страницы продуктов ради недостающих цен (медленнее)
 
         Returns:
             Список продуктов в формате:
@@ -34,31 +62,38 @@ class ProductSearchClient:
             ]
         """
         url = f"{self.base_url}/v1/search-products"
-        logger.info(f"[DEBUG] Attempting to connect to: {url}")
-        logger.info(f"[DEBUG] Query: {query}, num: {num}")
+        cache_key = (" ".join(query.lower().split()), num, enrich)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            logger.debug("Search %r served from cache", query)
+            return cached
 
         try:
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
-                logger.info(f"[DEBUG] Created httpx client, making request...")
-                response = await client.post(
+            # Общий пул соединений: keep-alive к сервису поиска переживает отдельные запросы
+            async with self._semaphore:
+                response = await get_http_client().post(
                     url,
-                    json={"query": query, "num": num},
-                    headers={"Content-Type": "application/json"}
+                    json={"query": query, "num": num, "enrich": enrich},
+                    timeout=self.timeout,
                 )
-                logger.info(f"[DEBUG] Got response: {response.status_code}")
-                response.raise_for_status()
-                data = response.json()
-                logger.info(f"[DEBUG] Successfully parsed JSON, got {len(data)} items")
-                return data
+            response.raise_for_status()
+            data = response.json()
+            logger.debug("Search %r returned %d items", query, len(data))
+            # Пустые ответы не кэшируем: это может быть временная проблема у поставщика
+            if data:
+                self._cache_put(cache_key, data)
+            return data
 
         except httpx.TimeoutException as e:
-            logger.error(f"[DEBUG] Timeout calling product search service: {url}, error: {e}")
+            logger.error("Timeout calling product search service: %s, error: %s", url, e)
             return []
         except httpx.HTTPStatusError as e:
-            logger.error(f"[DEBUG] HTTP error calling product search service: {e}, response: {e.response.text if e.response else 'No response'}")
+            logger.error("HTTP error calling product search service: %s, response: %s", e, e.response.text[:500])
             return []
         except Exception as e:
-            logger.error(f"[DEBUG] Error calling product search service: {e}, type: {type(e)}")
-            import traceback
-            logger.error(f"[DEBUG] Traceback: {traceback.format_exc()}")
+            logger.error("Error calling product search service: %r", e)
             return []
+
+
+# Один клиент на процесс: семафор должен быть общим для всех задач
+product_search_client = ProductSearchClient()
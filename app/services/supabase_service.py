@@ -1,11 +1,17 @@
 # app/services/supabase_service.py
 from typing import Dict, Any, Optional, List
-import json
+from collections import OrderedDict
+import asyncio
 from datetime import datetime
 from supabase import create_client, Client
 from pydantic import BaseModel
+import orjson
 import os
 
+from app.utils.logging import get_logger
+
+logger = get_logger("supabase")
+
 # Модели для работы с базой данных
 class SkinAnalysisJobCreate(BaseModel):
     job_id: str
@@ -43,6 +49,8 @@ class RecommendedProduct(BaseModel):
     suitable_for_skin_type: Optional[str] = None
     recommendation_order: int = 1
 
+# supabase-py синхронный: каждый execute() уходит в поток через asyncio.to_thread,
+# чтобы HTTP-запрос к Supabase не блокировал event loop
 class SupabaseService:
     def __init__(self):
         supabase_url = os.getenv("SUPABASE_URL")
@@ -52,81 +60,88 @@ class SupabaseService:
             raise ValueError("SUPABASE_URL and SUPABASE_KEY environment variables are required")
         
         self.client: Client = create_client(supabase_url, supabase_key)
+        # job_id -> UUID строки в skin_analysis_jobs: результаты и продукты пишутся без лишнего SELECT
+        self._job_uuids: OrderedDict[str, str] = OrderedDict()
+
+    def _remember_job_uuid(self, job_id: str, job_uuid: str) -> None:
+        self._job_uuids[job_id] = job_uuid
+        self._job_uuids.move_to_end(job_id)
+        while len(self._job_uuids) > 1024:
+            self._job_uuids.popitem(last=False)
+
+    async def _get_job_uuid(self, job_id: str) -> str:
+        """UUID задачи по job_id: из кэша, а если задача создана не этим процессом — из базы"""
+        job_uuid = self._job_uuids.get(job_id)
+        if job_uuid is not None:
+            return job_uuid
+        job = await self.get_job_by_job_id(job_id)
+        if not job:
+            raise ValueError(f"Job with job_id {job_id} not found")
+        self._remember_job_uuid(job_id, job["id"])
+        return job["id"]
     
     async def create_job(self, job_data: SkinAnalysisJobCreate) -> Dict[str, Any]:
         """Создать новую задачу анализа"""
         try:
-            response = self.client.table("skin_analysis_jobs").insert({
-                "job_id": job_data.job_id,
-                "image_url": job_data.image_url,
-                "user_text": job_data.user_text,
-                "mode": job_data.mode,
+            response = await asyncio.to_thread(self.client.table("skin_analysis_jobs").insert({
+                **job_data.model_dump(exclude_none=True),
                 "status": "in_progress"
-            }).execute()
+            }).execute)
             
-            return response.data[0] if response.data else {}
+            job = response.data[0] if response.data else {}
+            if job.get("id"):
+                self._remember_job_uuid(job_data.job_id, job["id"])
+            return job
         except Exception as e:
-            print(f"Error creating job in Supabase: {e}")
+            logger.error("Error creating job in Supabase: %s", e)
             raise
     
     async def update_job(self, job_id: str, update_data: SkinAnalysisJobUpdate) -> Dict[str, Any]:
         """Обновить статус задачи"""
         try:
-            update_dict = {}
-            
-            if update_data.status is not None:
-                update_dict["status"] = update_data.status
-            if update_data.progress is not None:
-                update_dict["progress"] = json.dumps(update_data.progress)
-            if update_data.error_message is not None:
-                update_dict["error_message"] = update_data.error_message
-            if update_data.timings is not None:
-                update_dict["timings"] = json.dumps(update_data.timings)
+            update_dict = update_data.model_dump(exclude_none=True)
+            for key in ("progress", "timings"):
+                if key in update_dict:
+                    update_dict[key] = orjson.dumps(update_dict[key]).decode()
             
-            response = self.client.table("skin_analysis_jobs").update(
+            response = await asyncio.to_thread(self.client.table("skin_analysis_jobs").update(
                 update_dict
-            ).eq("job_id", job_id).execute()
+            ).eq("job_id", job_id).execute)
             
             return response.data[0] if response.data else {}
         except Exception as e:
-            print(f"Error updating job in Supabase: {e}")
+            logger.error("Error updating job in Supabase: %s", e)
             raise
     
     async def get_job_by_job_id(self, job_id: str) -> Optional[Dict[str, Any]]:
         """Получить задачу по job_id"""
         try:
-            response = self.client.table("skin_analysis_jobs").select("*").eq(
+            response = await asyncio.to_thread(self.client.table("skin_analysis_jobs").select("*").eq(
                 "job_id", job_id
-            ).execute()
+            ).execute)
             
             return response.data[0] if response.data else None
         except Exception as e:
-            print(f"Error getting job from Supabase: {e}")
+            logger.exception("Error getting job from Supabase")
             return None
     
     async def save_analysis_result(self, result_data: SkinAnalysisResult) -> Dict[str, Any]:
         """Сохранить результат анализа"""
         try:
             # Получаем UUID задачи по job_id
-            job = await self.get_job_by_job_id(result_data.job_id)
-            if not job:
-                raise ValueError(f"Job with job_id {result_data.job_id} not found")
+            job_uuid = await self._get_job_uuid(result_data.job_id)
             
-            job_uuid = job["id"]
-            
-            response = self.client.table("skin_analysis_results").insert({
-                "job_id": job_uuid,
-                "diagnosis": result_data.diagnosis,
-                "skin_type": result_data.skin_type,
-                "explanation": result_data.explanation,
-                "medgemma_summary": result_data.medgemma_summary,
-                "planning_data": json.dumps(result_data.planning_data) if result_data.planning_data else None,
-                "final_result": json.dumps(result_data.final_result) if result_data.final_result else None
-            }).execute()
+            row = result_data.model_dump(exclude_none=True)
+            row["job_id"] = job_uuid
+            for key in ("planning_data", "final_result"):
+                if key in row:
+                    row[key] = orjson.dumps(row[key]).decode() if row[key] else None
+
+            response = await asyncio.to_thread(self.client.table("skin_analysis_results").insert(row).execute)
             
             return response.data[0] if response.data else {}
         except Exception as e:
-            print(f"Error saving analysis result to Supabase: {e}")
+            logger.error("Error saving analysis result to Supabase: %s", e)
             raise
     
     async def save_recommended_products(self, products: List[RecommendedProduct]) -> List[Dict[str, Any]]:
@@ -136,34 +151,18 @@ class SupabaseService:
         
         try:
             # Получаем UUID задачи по job_id первого продукта
-            job = await self.get_job_by_job_id(products[0].job_id)
-            if not job:
-                raise ValueError(f"Job with job_id {products[0].job_id} not found")
+            job_uuid = await self._get_job_uuid(products[0].job_id)
             
-            job_uuid = job["id"]
-            
-            products_data = []
-            for i, product in enumerate(products):
-                products_data.append({
-                    "job_id": job_uuid,
-                    "product_name": product.product_name,
-                    "brand": product.brand,
-                    "description": product.description,
-                    "price": product.price,
-                    "currency": product.currency,
-                    "product_url": product.product_url,
-                    "image_url": product.image_url,
-                    "category": product.category,
-                    "ingredients": product.ingredients,
-                    "benefits": product.benefits,
-                    "suitable_for_skin_type": product.suitable_for_skin_type,
-                    "recommendation_order": i + 1
-                })
+            # Без exclude_none: при пакетной вставке PostgREST требует одинаковый набор ключей у всех строк
+            products_data = [
+                {**product.model_dump(), "job_id": job_uuid, "recommendation_order": i + 1}
+                for i, product in enumerate(products)
+            ]
             
-            response = self.client.table("recommended_products").insert(products_data).execute()
+            response = await asyncio.to_thread(self.client.table("recommended_products").insert(products_data).execute)
             return response.data or []
         except Exception as e:
-            print(f"Error saving products to Supabase: {e}")
+            logger.error("Error saving products to Supabase: %s", e)
             raise
     
     async def get_full_analysis_result(self, job_id: str) -> Optional[Dict[str, Any]]:
@@ -176,15 +175,15 @@ class SupabaseService:
             
             job_uuid = job["id"]
             
-            # Получаем результат анализа
-            result_response = self.client.table("skin_analysis_results").select("*").eq(
-                "job_id", job_uuid
-            ).execute()
-            
-            # Получаем продукты
-            products_response = self.client.table("recommended_products").select("*").eq(
-                "job_id", job_uuid
-            ).order("recommendation_order").execute()
+            # Результат анализа и продукты запрашиваем параллельно
+            result_response, products_response = await asyncio.gather(
+                asyncio.to_thread(self.client.table("skin_analysis_results").select("*").eq(
+                    "job_id", job_uuid
+                ).execute),
+                asyncio.to_thread(self.client.table("recommended_products").select("*").eq(
+                    "job_id", job_uuid
+                ).order("recommendation_order").execute),
+            )
             
             result = result_response.data[0] if result_response.data else {}
             products = products_response.data or []
@@ -195,7 +194,7 @@ class SupabaseService:
                 "products": products
             }
         except Exception as e:
-            print(f"Error getting full analysis result from Supabase: {e}")
+            logger.exception("Error getting full analysis result from Supabase")
             return None
     
     async def cleanup_old_jobs(self, days: int = 30):
@@ -204,13 +203,13 @@ class SupabaseService:
             from datetime import datetime, timedelta
             cutoff_date = (datetime.now() - timedelta(days=days)).isoformat()
             
-            response = self.client.table("skin_analysis_jobs").delete().lt(
+            response = await asyncio.to_thread(self.client.table("skin_analysis_jobs").delete().lt(
                 "created_at", cutoff_date
-            ).execute()
+            ).execute)
             
             return len(response.data) if response.data else 0
         except Exception as e:
-            print(f"Error cleaning up old jobs: {e}")
+            logger.exception("Error cleaning up old jobs")
             return 0
 
 # Создание глобального экземпляра сервиса
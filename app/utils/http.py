@@ -0,0 +1,28 @@
+import httpx
+
+from app.config import settings
+
+
+# Общие лимиты пула: keep-alive соединения переиспользуются между задачами и ходами Gemini
+HTTP_LIMITS = httpx.Limits(
+	max_keepalive_connections=settings.http_max_keepalive_connections,
+	max_connections=settings.http_max_connections,
+	keepalive_expiry=settings.http_keepalive_expiry,
+)
+
+_client: httpx.AsyncClient | None = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+	"""Общий пул соединений для исходящих HTTP-запросов (keep-alive между задачами)"""
+	global _client
+	if _client is None or _client.is_closed:
+		_client = httpx.AsyncClient(timeout=httpx.Timeout(15.0), limits=HTTP_LIMITS)
+	return _client
+
+
+async def close_http_client() -> None:
+	global _client
+	if _client is not None and not _client.is_closed:
+		await _client.aclose()
+	_client = None
@@ -0,0 +1,80 @@
+import json
+from typing import Any, Dict
+
+
+_decoder = json.JSONDecoder()
+_WS = " \t\r\n"
+
+
+class StreamingJSONObject:
+	"""
+	Инкрементальный разбор JSON-объекта верхнего уровня, приходящего кусками.
+
+	После каждого feed() в fields лежат все пары key/value, которые уже пришли целиком,
+	так что первые поля ответа (diagnosis, skin_type) доступны до конца генерации.
+	Разобранная часть буфера отбрасывается: в памяти и при повторном разборе
+	остаётся только недописанное поле.
+	"""
+
+	def __init__(self) -> None:
+		self.fields: Dict[str, Any] = {}
+		self._buf = ""
+		self._pos = 0
+		self._started = False
+		self._closed = False
+
+	def _skip(self, chars: str) -> int:
+		pos = self._pos
+		while pos < len(self._buf) and self._buf[pos] in chars:
+			pos += 1
+		return pos
+
+	def feed(self, chunk: str) -> Dict[str, Any]:
+		"""Добавляет кусок текста и возвращает поля, завершённые этим куском"""
+		completed: Dict[str, Any] = {}
+		if self._closed:
+			return completed
+		self._buf += chunk
+
+		if not self._started:
+			pos = self._skip(_WS)
+			if pos >= len(self._buf):
+				return completed
+			if self._buf[pos] != "{":
+				self._closed = True  # не объект — оставляем разбор финальному json.loads
+				return completed
+			self._pos, self._started = pos + 1, True
+
+		while True:
+			pos = self._skip(_WS + ",")
+			if pos >= len(self._buf):
+				break
+			if self._buf[pos] == "}":
+				self._closed = True
+				break
+			try:
+				key, pos = _decoder.raw_decode(self._buf, pos)
+				while pos < len(self._buf) and self._buf[pos] in _WS:
+					pos += 1
+				if pos >= len(self._buf) or self._buf[pos] != ":":
+					break
+				pos += 1
+				while pos < len(self._buf) and self._buf[pos] in _WS:
+					pos += 1
+				value, end = _decoder.raw_decode(self._buf, pos)
+			except json.JSONDecodeError:
+				break  # значение ещё не дописано
+			# Число на границе куска может быть обрезано ("12" из "123") — ждём следующий символ
+			if isinstance(value, (int, float)) and not isinstance(value, bool) and end >= len(self._buf):
+				break
+			if not isinstance(key, str):
+				self._closed = True
+				break
+			completed[key] = value
+			self._pos = end
+
+		if self._pos:
+			# Без этого += на каждом куске копировал бы весь ответ целиком
+			self._buf, self._pos = self._buf[self._pos:], 0
+		self.fields.update(completed)
+		return completed
@@ -1,18 +1,21 @@
+import functools
 import logging
 import sys
 
+# Один handler на все логгеры приложения
+_HANDLER = logging.StreamHandler(sys.stdout)
+_HANDLER.setFormatter(logging.Formatter(
+	fmt='%(asctime)s %(levelname)s %(name)s - %(message)s',
+	datefmt='%Y-%m-%dT%H:%M:%S%z'
+))
 
+
+@functools.lru_cache(maxsize=None)
 def get_logger(name: str) -> logging.Logger:
 	logger = logging.getLogger(name)
 	if logger.handlers:
 		return logger
 	logger.setLevel(logging.INFO)
-	handler = logging.StreamHandler(sys.stdout)
-	formatter = logging.Formatter(
-		fmt='%(asctime)s %(levelname)s %(name)s - %(message)s',
-		datefmt='%Y-%m-%dT%H:%M:%S%z'
-	)
-	handler.setFormatter(formatter)
-	logger.addHandler(handler)
+	logger.addHandler(_HANDLER)
 	logger.propagate = False
 	return logger
@@ -6,9 +6,18 @@ from dataclasses import dataclass
 class Settings:
     api_host: str = os.getenv("API_HOST", "0.0.0.0")
     api_port: int = int(os.getenv("API_PORT", "8001"))
+    # Comma-separated browser origins allowed by CORS; "*" allows any origin without credentials
+    cors_allow_origins: str = os.getenv("CORS_ALLOW_ORIGINS", "*")
 
     google_cse_api_key: str | None = os.getenv("GOOGLE_CSE_API_KEY")
     google_cse_cx: str | None = os.getenv("GOOGLE_CSE_CX")
 
+    # Redis cache of CSE results shared by workers (empty REDIS_URL disables it)
+    redis_url: str = os.getenv("REDIS_URL", "")
+    cse_cache_ttl_seconds: int = int(os.getenv("CSE_CACHE_TTL_SECONDS", "21600"))
+    # In-process LRU in front of Redis for the hottest queries (TTL 0 disables it)
+    cse_local_cache_ttl_seconds: int = int(os.getenv("CSE_LOCAL_CACHE_TTL_SECONDS", "600"))
+    cse_local_cache_max_entries: int = int(os.getenv("CSE_LOCAL_CACHE_MAX_ENTRIES", "512"))
+
 
 settings = Settings()
@@ -1,16 +1,57 @@
 from __future__ import annotations
 from typing import List, Dict, Any, Optional
-import httpx
-import os
+import asyncio
+import random
 import re
 import json
-from bs4 import BeautifulSoup
+import httpx
+import orjson
+from selectolax.parser import HTMLParser
 from app.config import settings
+from app.utils.http import get_http_client
 from app.utils.logging import get_logger
 
 
 logger = get_logger("search")
 GOOGLE_SEARCH_URL = "https://www.googleapis.com/customsearch/v1"
+# Сколько страниц продуктов качаем одновременно в рамках одного поиска
+PRICE_FETCH_CONCURRENCY = 5
+# Потолок паузы между попытками CSE: дольше клиент основного API всё равно не ждёт
+MAX_RETRY_DELAY = 8.0
+
+# Цена и JSON-LD почти всегда в начале страницы; дальше обычно CSS-in-JS и скрипты
+MAX_HTML_BYTES = 256 * 1024
+
+# Числа с валютными символами; компилируем один раз, а не на каждый элемент страницы
+_PRICE_RE = re.compile(r'(\$|€|£|¥|₽)?\s*(\d+(?:\.\d{2})?)')
+_HAS_DIGIT = re.compile(r'\d').search
+
+# Популярные селекторы для цен
+PRICE_SELECTORS = (
+    # Общие селекторы
+    '[data-testid="price"]',
+    '.price',
+    '.product-price',
+    '.product-price-current',
+    '.price-current',
+    '[data-cy="price"]',
+    '.price-tag',
+    '.price-value',
+    '.product-price-value',
+    # Ulta Beauty
+    '.ProductCard__price',
+    '.Price',
+    # Sephora
+    '.css-1f35b1j',
+    '.css-14hdny2',
+    # Amazon
+    '.a-price-whole',
+    '.a-price-fraction',
+    # Common patterns
+    'span[class*="price"]',
+    'div[class*="price"]',
+    'meta[property="product:price:amount"]',
+)
 
 
 async def extract_price_from_url(url: str) -> Optional[str]:
@@ -24,82 +65,110 @@ async def extract_price_from_url(url: str) -> Optional[str]:
         Цена в виде строки или None если не найдена
     """
     try:
-        async with httpx.AsyncClient(timeout=10.0, follow_redirects=True) as client:
-            resp = await client.get(url)
+        # Читаем не больше MAX_HTML_BYTES: остаток страницы не качаем и не парсим
+        body = bytearray()
+        async with get_http_client().stream("GET", url, timeout=10.0, follow_redirects=True) as resp:
             resp.raise_for_status()
+            async for chunk in resp.aiter_bytes():
+                body += chunk
+                if len(body) >= MAX_HTML_BYTES:
+                    break
+            encoding = resp.charset_encoding or "utf-8"
+
+        # selectolax (C-парсер) разбирает многомегабайтные страницы магазинов в десятки раз быстрее html.parser
+        tree = HTMLParser(body[:MAX_HTML_BYTES].decode(encoding, errors="ignore"))
+
+        for selector in PRICE_SELECTORS:
+            price_elements = tree.css(selector)
+            if price_elements:
+                for elem in price_elements:
+                    text = elem.text(strip=True)
+                    # Ищем числа с валютными символами
+                    match = _PRICE_RE.search(text)
+                    if match:
+                        currency = match.group(1) or '$'
+                        price = match.group(2)
+                        return f"{currency}{price}"
+
+                    # Если не нашли паттерн, возвращаем весь текст
+                    if text and _HAS_DIGIT(text):
+                        return text
+
+        # Если не нашли с селекторами, ищем в JSON-LD
+        scripts = tree.css('script[type="application/ld+json"]')
+        for script in scripts:
+            try:
+                data = json.loads(script.text())
+                if isinstance(data, dict) and data.get('@type') == 'Product':
+                    offers = data.get('offers', {})
+                    if isinstance(offers, dict):
+                        price = offers.get('price')
+                        if price:
+                            return str(price)
+                    elif isinstance(offers, list) and offers:
+                        price = offers[0].get('price')
+                        if price:
+                            return str(price)
+            except (json.JSONDecodeError, AttributeError):
+                continue
 
-            soup = BeautifulSoup(resp.text, 'html.parser')
-
-            # Популярные селекторы для цен
-            price_selectors = [
-                # Общие селекторы
-                '[data-testid="price"]',
-                '.price',
-                '.product-price',
-                '.product-price-current',
-                '.price-current',
-                '[data-cy="price"]',
-                '.price-tag',
-                '.price-value',
-                '.product-price-value',
-                # Ulta Beauty
-                '.ProductCard__price',
-                '.Price',
-                # Sephora
-                '.css-1f35b1j',
-                '.css-14hdny2',
-                # Amazon
-                '.a-price-whole',
-                '.a-price-fraction',
-                # Common patterns
-                'span[class*="price"]',
-                'div[class*="price"]',
-                'meta[property="product:price:amount"]',
-            ]
-
-            for selector in price_selectors:
-                price_elements = soup.select(selector)
-                if price_elements:
-                    for elem in price_elements:
-                        text = elem.get_text(strip=True)
-                        # Ищем числа с валютными символами
-                        price_pattern = r'(\$|€|£|¥|₽)?\s*(\d+(?:\.\d{2})?)'
-                        match = re.search(price_pattern, text)
-                        if match:
-                            currency = match.group(1) or '$'
-                            price = match.group(2)
-                            return f"{currency}{price}"
-
-                        # Если не нашли паттерн, возвращаем весь текст
-                        if text and any(char.isdigit() for char in text):
-                            return text
-
-            # Если не нашли с селекторами, ищем в JSON-LD
-            scripts = soup.find_all('script', type='application/ld+json')
-            for script in scripts:
-                try:
-                    data = json.loads(script.string)
-                    if isinstance(data, dict) and data.get('@type') == 'Product':
-                        offers = data.get('offers', {})
-                        if isinstance(offers, dict):
-                            price = offers.get('price')
-                            if price:
-                                return str(price)
-                        elif isinstance(offers, list) and offers:
-                            price = offers[0].get('price')
-                            if price:
-                                return str(price)
-                except (json.JSONDecodeError, AttributeError):
-                    continue
-
-            return None
+        return None
 
     except Exception as e:
-        logger.warning(f"Failed to extract price from {url}: {e}")
+        logger.warning("Failed to extract price from %s: %s", url, e)
+        return None
+
+
+async def _fill_missing_prices(results: List[Dict[str, Any]]) -> None:
+    missing = [p for p in results if not p["price"] and p["url"]]
+    if not missing:
+        return
+    semaphore = asyncio.Semaphore(PRICE_FETCH_CONCURRENCY)
+
+    async def fill(p: Dict[str, Any]) -> None:
+        async with semaphore:
+            extracted_price = await extract_price_from_url(p["url"])
+        if extracted_price:
+            p["price"] = extracted_price
+            logger.info("Extracted price from %s: %s", p['url'], extracted_price)
+
+    outcomes = await asyncio.gather(*(fill(p) for p in missing), return_exceptions=True)
+    for p, outcome in zip(missing, outcomes):
+        if isinstance(outcome, Exception):
+            logger.warning("Failed to extract price from %s: %s", p['url'], outcome)
+
+
+def _as_float(value: Any) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
         return None
 
 
-async def search_products(query: str, num: int = 10) -> List[Dict[str, Any]]:
+def _retry_delay(e: Exception, attempt: int) -> Optional[float]:
+    """Пауза перед следующей попыткой CSE или None, если повторять бессмысленно"""
+    backoff = min(2 ** attempt, MAX_RETRY_DELAY) + random.random()
+    if not isinstance(e, httpx.HTTPStatusError):
+        return backoff  # таймауты и сетевые ошибки
+    status = e.response.status_code
+    if status == 429:
+        try:
+            retry_after = float(e.response.headers.get("Retry-After", ""))
+        except ValueError:
+            return backoff
+        return retry_after if retry_after <= MAX_RETRY_DELAY else None
+    if status >= 500:
+        return backoff
+    return None  # остальные 4xx (ключ, дневная квота) повтором не лечатся
+
+
+async def search_products(query: str, num: int = 10, enrich: bool = True) -> List[Dict[str, Any]]:
+    """
+    Поиск через Google CSE.
+
+    enrich=False пропускает догрузку страниц продуктов для цен, которых нет в pagemap:
+    ответ приходит за один запрос к CSE, цены остаются только из pagemap.
+    """
     if not settings.google_cse_api_key or not settings.google_cse_cx:
         logger.warning("Google CSE keys missing; returning empty products")
         return []
@@ -115,100 +184,99 @@ async def search_products(query: str, num: int = 10) -> List[Dict[str, Any]]:
     while attempts < 3:
         attempts += 1
         try:
-            async with httpx.AsyncClient(timeout=15.0) as client:
-                resp = await client.get(GOOGLE_SEARCH_URL.strip(), params=params)
-                resp.raise_for_status()
-                data = resp.json()
-                items = data.get("items", [])
-                results: List[Dict[str, Any]] = []
-                for it in items:
-                    # Извлекаем больше данных из pagemap
-                    pagemap = it.get("pagemap", {})
-
-                    # Цена (может быть в разных форматах)
-                    price = None
-                    if pagemap.get("product"):
-                        product_data = pagemap["product"][0]
-                        # Проверяем offers.price
-                        if product_data.get("offers", {}).get("price"):
-                            price = product_data["offers"]["price"]
-                        # Проверяем product.price
-                        elif product_data.get("price"):
-                            price = product_data["price"]
-                        # Проверяем offers.pricecurrency
-                        elif product_data.get("offers", {}).get("pricecurrency"):
-                            price = product_data["offers"]["pricecurrency"]
-
-                    # Альтернативные источники цены
-                    if not price:
-                        # Из metatags (Open Graph, Twitter cards)
-                        if pagemap.get("metatags"):
-                            for tag in pagemap["metatags"]:
-                                if tag.get("product:price:amount"):
-                                    price = tag["product:price:amount"]
-                                    break
-                                elif tag.get("twitter:data1"):
-                                    # Twitter cards иногда содержат цену
-                                    twitter_data = tag["twitter:data1"]
-                                    if "$" in twitter_data or "price" in twitter_data.lower():
-                                        price = twitter_data
-                                        break
+            resp = await get_http_client().get(GOOGLE_SEARCH_URL, params=params)
+            resp.raise_for_status()
+            # Ответ CSE с pagemap бывает на сотни КБ; orjson разбирает его в разы быстрее stdlib
+            data = orjson.loads(resp.content)
+            items = data.get("items", [])
+            results: List[Dict[str, Any]] = []
+            for it in items:
+                # Извлекаем больше данных из pagemap
+                pagemap = it.get("pagemap", {})
 
-                        # Из structured data
-                        if pagemap.get("jsonld"):
-                            for json_data in pagemap["jsonld"]:
-                                if isinstance(json_data, dict):
-                                    if json_data.get("@type") == "Product":
-                                        if json_data.get("offers", {}).get("price"):
-                                            price = json_data["offers"]["price"]
-                                            break
-
-                    # Бренд
-                    brand = None
-                    if pagemap.get("product"):
-                        brand = pagemap["product"][0].get("brand")
-                    elif pagemap.get("metatags"):
+                # Цена (может быть в разных форматах)
+                price = None
+                if pagemap.get("product"):
+                    product_data = pagemap["product"][0]
+                    # Проверяем offers.price
+                    if product_data.get("offers", {}).get("price"):
+                        price = product_data["offers"]["price"]
+                    # Проверяем product.price
+                    elif product_data.get("price"):
+                        price = product_data["price"]
+                    # Проверяем offers.pricecurrency
+                    elif product_data.get("offers", {}).get("pricecurrency"):
+                        price = product_data["offers"]["pricecurrency"]
+
+                # Альтернативные источники цены
+                if not price:
+                    # Из metatags (Open Graph, Twitter cards)
+                    if pagemap.get("metatags"):
                         for tag in pagemap["metatags"]:
-                            if tag.get("og:site_name"):
-                                brand = tag["og:site_name"]
+                            if tag.get("product:price:amount"):
+                                price = tag["product:price:amount"]
                                 break
+                            elif tag.get("twitter:data1"):
+                                # Twitter cards иногда содержат цену
+                                twitter_data = tag["twitter:data1"]
+                                if "$" in twitter_data or "price" in twitter_data.lower():
+                                    price = twitter_data
+                                    break
+
+                    # Из structured data
+                    if pagemap.get("jsonld"):
+                        for json_data in pagemap["jsonld"]:
+                            if isinstance(json_data, dict):
+                                if json_data.get("@type") == "Product":
+                                    if json_data.get("offers", {}).get("price"):
+                                        price = json_data["offers"]["price"]
+                                        break
+
+                # Бренд
+                brand = None
+                if pagemap.get("product"):
+                    brand = pagemap["product"][0].get("brand")
+                elif pagemap.get("metatags"):
+                    for tag in pagemap["metatags"]:
+                        if tag.get("og:site_name"):
+                            brand = tag["og:site_name"]
+                            break
+
+                # Категория
+                category = None
+                if pagemap.get("product"):
+                    category = pagemap["product"][0].get("category")
+
+                # Рейтинг
+                rating = None
+                if pagemap.get("aggregaterating"):
+                    rating = _as_float(pagemap["aggregaterating"][0].get("ratingvalue"))
+
+                p = {
+                    "name": it.get("title", "Unknown Product"),
+                    "url": it.get("link", ""),
+                    "snippet": it.get("snippet", ""),
+                    "image_url": (pagemap.get("cse_image", [{}])[0].get("src") if pagemap.get("cse_image") else None),
+                    "price": str(price) if price is not None else None,
+                    "brand": brand,
+                    "category": category,
+                    "rating": rating,
+                }
+
+                # Фильтруем пустые результаты
+                if p["name"] and p["url"]:
+                    results.append(p)
 
-                    # Категория
-                    category = None
-                    if pagemap.get("product"):
-                        category = pagemap["product"][0].get("category")
-
-                    # Рейтинг
-                    rating = None
-                    if pagemap.get("aggregaterating"):
-                        rating = pagemap["aggregaterating"][0].get("ratingvalue")
-
-                    p = {
-                        "name": it.get("title", "Unknown Product"),
-                        "url": it.get("link", ""),
-                        "snippet": it.get("snippet", ""),
-                        "image_url": (pagemap.get("cse_image", [{}])[0].get("src") if pagemap.get("cse_image") else None),
-                        "price": price,
-                        "brand": brand,
-                        "category": category,
-                        "rating": rating,
-                    }
-
-                    # Если цена не найдена в pagemap, пытаемся извлечь с сайта
-                    if not p["price"] and p["url"]:
-                        try:
-                            extracted_price = await extract_price_from_url(p["url"])
-                            if extracted_price:
-                                p["price"] = extracted_price
-                                logger.info(f"Extracted price from {p['url']}: {extracted_price}")
-                        except Exception as e:
-                            logger.warning(f"Failed to extract price from {p['url']}: {e}")
-
-                    # Фильтруем пустые результаты
-                    if p["name"] and p["url"]:
-                        results.append(p)
-                return results if results else []  # Возвращаем пустой список если ничего нет
+            # Если цена не найдена в pagemap, пытаемся извлечь с сайта — все страницы параллельно
+            if enrich:
+                await _fill_missing_prices(results)
+            return results if results else []  # Возвращаем пустой список если ничего нет
         except Exception as e:
-            logger.warning(f"Google CSE attempt {attempts} failed: {e}")
+            logger.warning("Google CSE attempt %d failed: %s", attempts, e)
+            delay = _retry_delay(e, attempts)
+            if delay is None:
+                break
+            if attempts < 3:
+                await asyncio.sleep(delay)
     logger.error("Google CSE all attempts failed; returning empty list")
     return []
@@ -0,0 +1,96 @@
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import orjson
+
+from app.config import settings
+from app.utils.logging import get_logger
+
+logger = get_logger("search_cache")
+
+
+class SearchCache:
+	"""
+	Двухуровневый кэш результатов поиска.
+
+	L1 — LRU с коротким TTL в памяти процесса: самые частые запросы без похода в сеть.
+	L2 — Redis, общий для всех воркеров; без REDIS_URL остаётся только L1.
+	Ошибки Redis не ломают поиск — запрос просто идёт в CSE.
+	"""
+
+	def __init__(self, url: str, ttl_seconds: int, local_ttl_seconds: int, local_max_entries: int) -> None:
+		self.ttl_seconds = ttl_seconds
+		self.local_ttl_seconds = local_ttl_seconds
+		self.local_max_entries = local_max_entries
+		# key -> (expires_at, results)
+		self._local: OrderedDict[str, Tuple[float, List[Dict[str, Any]]]] = OrderedDict()
+		self._redis = None
+		if url and ttl_seconds > 0:
+			import redis.asyncio as redis
+
+			self._redis = redis.from_url(url)
+
+	@staticmethod
+	def _key(query: str, num: int, enrich: bool) -> str:
+		# Тривиальные варианты запроса (регистр, пробелы) попадают в один ключ
+		normalized = " ".join(query.lower().split())
+		digest = hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).hexdigest()
+		return f"cse:{digest}:{num}:{int(enrich)}"
+
+	def _local_get(self, key: str) -> Optional[List[Dict[str, Any]]]:
+		entry = self._local.get(key)
+		if entry is None:
+			return None
+		if entry[0] <= time.monotonic():
+			del self._local[key]
+			return None
+		self._local.move_to_end(key)
+		return entry[1]
+
+	def _local_put(self, key: str, results: List[Dict[str, Any]]) -> None:
+		if self.local_ttl_seconds <= 0 or self.local_max_entries <= 0:
+			return
+		self._local[key] = (time.monotonic() + self.local_ttl_seconds, results)
+		self._local.move_to_end(key)
+		while len(self._local) > self.local_max_entries:
+			self._local.popitem(last=False)
+
+	async def get(self, query: str, num: int, enrich: bool) -> Optional[List[Dict[str, Any]]]:
+		key = self._key(query, num, enrich)
+		results = self._local_get(key)
+		if results is not None or self._redis is None:
+			return results
+		try:
+			cached = await self._redis.get(key)
+		except Exception as e:
+			logger.warning("Search cache read failed: %s", e)
+			return None
+		if not cached:
+			return None
+		results = orjson.loads(cached)
+		self._local_put(key, results)
+		return results
+
+	async def set(self, query: str, num: int, enrich: bool, results: List[Dict[str, Any]]) -> None:
+		key = self._key(query, num, enrich)
+		self._local_put(key, results)
+		if self._redis is None:
+			return
+		try:
+			await self._redis.set(key, orjson.dumps(results), ex=self.ttl_seconds)
+		except Exception as e:
+			logger.warning("Search cache write failed: %s", e)
+
+	async def close(self) -> None:
+		if self._redis is not None:
+			await self._redis.aclose()
+
+
+search_cache = SearchCache(
+	settings.redis_url,
+	settings.cse_cache_ttl_seconds,
+	settings.cse_local_cache_ttl_seconds,
+	settings.cse_local_cache_max_entries,
+)
@@ -0,0 +1,25 @@
+import httpx
+
+
+# Один пул на процесс: TLS-рукопожатие с googleapis и магазинами не повторяется на каждый запрос
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+
+_client: httpx.AsyncClient | None = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+	"""Общий AsyncClient для запросов к Google CSE и страницам продуктов"""
+	global _client
+	if _client is None or _client.is_closed:
+		# HTTP/2 мультиплексирует запросы к googleapis.com в одном соединении;
+		# retries=1 повторяет только неудавшееся установление соединения
+		transport = httpx.AsyncHTTPTransport(http2=True, limits=HTTP_LIMITS, retries=1)
+		_client = httpx.AsyncClient(timeout=httpx.Timeout(15.0, connect=5.0), transport=transport)
+	return _client
+
+
+async def close_http_client() -> None:
+	global _client
+	if _client is not None and not _client.is_closed:
+		await _client.aclose()
+	_client = None
@@ -1,19 +1,53 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Dict, Any
-import os
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field
+from typing import List, Dict, Any, Tuple
+import asyncio
+
+import orjson
 
 from app.tools.search_products import search_products
 from app.config import settings
+from app.utils.cache import search_cache
+from app.utils.http import close_http_client
 from app.utils.logging import get_logger
 
-app = FastAPI(title="Product Search API", version="0.1.0")
 logger = get_logger("product_search")
 
+# Ключи читаются из окружения один раз при старте, проверяем их тоже один раз
+_CSE_READY = bool(settings.google_cse_api_key and settings.google_cse_cx)
+_NOT_CONFIGURED_DETAIL = "Product search service not configured"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logger.info("Product Search API starting up")
+    if not _CSE_READY:
+        logger.warning("Google CSE API keys not configured")
+    yield
+    logger.info("Product Search API shutting down")
+    # Пул соединений к CSE/магазинам и клиент Redis живут всё время работы процесса
+    await close_http_client()
+    await search_cache.close()
+
+
+# orjson сериализует ответы напрямую, минуя jsonable_encoder и stdlib json
+app = FastAPI(
+    title="Product Search API",
+    version="0.1.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
+
 class ProductSearchRequest(BaseModel):
-    query: str
-    num: int = 10
+    # Границы проверяются при разборе тела: некорректный запрос не доходит до CSE
+    query: str = Field(..., min_length=1, max_length=256)
+    num: int = Field(10, ge=1, le=10)
+    # Догружать страницы продуктов ради цен, которых нет в выдаче CSE (медленнее)
+    enrich: bool = True
 
 class ProductResponse(BaseModel):
     name: str
@@ -25,29 +59,105 @@ class ProductResponse(BaseModel):
     category: str | None = None
     rating: float | None = None
 
+def _shape(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Результат search_products -> элемент ответа (поля ProductResponse)"""
+    get = result.get
+    return {
+        "name": get("name", "Unknown Product"),
+        "url": get("url", ""),
+        "snippet": get("snippet", ""),
+        "image_url": get("image_url"),
+        "price": get("price"),
+        "brand": get("brand"),
+        "category": get("category"),
+        "rating": get("rating"),
+    }
+
+
+# Незавершённые поиски: одинаковые параллельные запросы ждут один вызов CSE (single-flight)
+_inflight: Dict[Tuple[str, int, bool], asyncio.Task] = {}
+
+
+async def _search_and_cache(query: str, num: int, enrich: bool) -> List[Dict[str, Any]]:
+    results = await search_products(query, num, enrich)
+    # Пустой ответ может означать сбой CSE — не кэшируем
+    if results:
+        await search_cache.set(query, num, enrich, results)
+    return results
+
+
+_INTERNAL_ERROR_BODY = orjson.dumps({"detail": "Internal server error"})
+
+
+class UnhandledErrorMiddleware:
+    """
+    Непредвиденные ошибки роутов -> 500 с фиксированным detail.
+
+    Чистый ASGI без BaseHTTPMiddleware: на запрос только try и обёртка send.
+    Добавлен первым и стоит внутри CORS, поэтому у ответа 500 есть CORS-заголовки;
+    HTTPException сюда не доходит — его уже обработал встроенный handler FastAPI.
+    Текст ошибки (может содержать URL CSE с ключом) остаётся только в логе
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = False
+
+        async def send_wrapper(message) -> None:
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception as exc:
+            logger.error("Error in %s: %r", scope.get("path"), exc)
+            if started:
+                # Заголовки уже ушли клиенту, новый ответ не отправить
+                return
+            await send({
+                "type": "http.response.start",
+                "status": 500,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(_INTERNAL_ERROR_BODY)).encode()),
+                ],
+            })
+            await send({"type": "http.response.body", "body": _INTERNAL_ERROR_BODY})
+
+
+app.add_middleware(UnhandledErrorMiddleware)
+
+
+# Список из 10 продуктов с URL и сниппетами — несколько КБ JSON, хорошо сжимается.
+# Добавлен раньше CORS, поэтому стоит внутри него, ближе к роутам
+app.add_middleware(GZipMiddleware, minimum_size=500, compresslevel=5)
+
+# Конкретный список origin'ов проверяется простым вхождением; "*" вместе с credentials
+# запрещён спецификацией CORS, поэтому credentials разрешаем только для явного списка
+_CORS_ORIGINS = [o.strip() for o in settings.cors_allow_origins.split(",") if o.strip()]
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=_CORS_ORIGINS,
+    allow_credentials="*" not in _CORS_ORIGINS,
+    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_headers=["Content-Type", "Authorization"],
 )
 
-@app.on_event("startup")
-async def on_startup():
-    logger.info("Product Search API starting up")
-    if not settings.google_cse_api_key or not settings.google_cse_cx:
-        logger.warning("Google CSE API keys not configured")
-
-@app.on_event("shutdown")
-async def on_shutdown():
-    logger.info("Product Search API shutting down")
-
 @app.get("/health")
 async def health():
     return {"status": "ok"}
 
-@app.post("/v1/search-products", response_model=List[ProductResponse])
+# ProductResponse остаётся только для схемы OpenAPI: без response_model FastAPI не валидирует
+# и не сериализует ответ повторно
+@app.post("/v1/search-products", responses={200: {"model": List[ProductResponse]}})
 async def search_products_endpoint(request: ProductSearchRequest):
     """
     Поиск продуктов для ухода за кожей
@@ -60,34 +170,23 @@ async def search_products_endpoint(request: ProductSearchRequest):
     Returns:
         Список найденных продуктов
     """
-    try:
-        if not settings.google_cse_api_key or not settings.google_cse_cx:
-            raise HTTPException(
-                status_code=503,
-                detail="Product search service not configured"
-            )
-
-        # Выполняем поиск
-        results = await search_products(request.query, request.num)
-
-        # Преобразуем результаты в нужный формат
-        products = []
-        for result in results:
-            products.append(ProductResponse(
-                name=result.get("name", "Unknown Product"),
-                url=result.get("url", ""),
-                snippet=result.get("snippet", ""),
-                image_url=result.get("image_url"),
-                price=result.get("price"),
-                brand=result.get("brand"),
-                category=result.get("category"),
-                rating=result.get("rating")
-            ))
-
-        return products
-
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.exception("Error in product search")
-        raise HTTPException(status_code=500, detail=str(e))
+    if not _CSE_READY:
+        raise HTTPException(status_code=503, detail=_NOT_CONFIGURED_DETAIL)
+
+    # Выполняем поиск; повторяющиеся запросы отдаём из кэша без похода в CSE
+    results = await search_cache.get(request.query, request.num, request.enrich)
+    if results is None:
+        key = (" ".join(request.query.lower().split()), request.num, request.enrich)
+        task = _inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(_search_and_cache(request.query, request.num, request.enrich))
+            _inflight[key] = task
+            task.add_done_callback(lambda _t, k=key: _inflight.pop(k, None))
+        # shield: отмена одного клиента не должна отменять поиск для остальных ожидающих
+        results = await asyncio.shield(task)
+
+    # Преобразуем результаты в нужный формат.
+    # Данные собраны нашим же search_products (price — str, rating — float), валидацию пропускаем.
+    # Готовый ORJSONResponse FastAPI отдаёт как есть, без прохода jsonable_encoder по списку
+    return ORJSONResponse([_shape(result) for result in results])
+